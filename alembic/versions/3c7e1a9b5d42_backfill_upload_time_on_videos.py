@@ -0,0 +1,28 @@
+"""Backfill upload time on videos
+
+Revision ID: 3c7e1a9b5d42
+Revises: 5a9e2d7c3b18
+Create Date: 2026-10-18 21:12:40.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c7e1a9b5d42'
+down_revision = '5a9e2d7c3b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Cursor pagination skips rows without an upload time
+    op.execute(sa.text(
+        "UPDATE videos SET upload_time = COALESCE(orig_upload_time, '1970-01-01 00:00:00') "
+        "WHERE upload_time IS NULL"
+    ))
+
+
+def downgrade():
+    pass
@@ -61,6 +61,9 @@ def create_app():
 
     cache.init_app(app)
 
+    from .commands import register_commands
+    register_commands(app)
+
     @app.errorhandler(404)
     def page_not_found(_e):
         return redirect("https://" if request.is_secure else "http://" + app.config["SERVER_NAME"])
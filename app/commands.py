@@ -0,0 +1,52 @@
+"""
+    Maintenance commands for the archive, run with e.g. `flask --app wsgi backfill-images`.
+"""
+import click
+
+
+def register_commands(app):
+    @app.cli.command("backfill-images")
+    @click.option("--workers", type=int, default=None, help="Conversion processes, one per CPU by default.")
+    def backfill_images(workers):
+        """
+            Writes missing WebP/AVIF variants and publishes versioned images for every video.
+        """
+        from app.dl.dl import convert_all_image_variants
+        from app.core.tasks import publish_images_task
+
+        # In this process, Celery's prefork workers can't run a process pool
+        converted = convert_all_image_variants(workers)
+        published = publish_images_task()
+        click.echo(f"Converted {converted} images, published new images for {published} videos.")
+
+    @app.cli.command("faststart-archive")
+    def faststart_archive():
+        """
+            Remuxes originals and processed files that still have their moov atom at the end.
+        """
+        from app.core.tasks import faststart_archive_task
+
+        remuxed = faststart_archive_task()
+        click.echo(f"Remuxed {remuxed} files.")
+
+    @app.cli.command("fingerprint-archive")
+    def fingerprint_archive():
+        """
+            Samples frame and audio fingerprints for completed videos that don't have them yet.
+        """
+        from app.core.tasks import fingerprint_archive_task
+
+        frames, audio = fingerprint_archive_task()
+        click.echo(f"Added frame fingerprints for {frames} and audio fingerprints for {audio} videos.")
+
+    @app.cli.command("reindex-videos")
+    def reindex_videos():
+        """
+            Rebuilds the search index with the current mappings and swaps it in.
+        """
+        from app.serve.db import Video, session_scope
+        from app.serve import search
+
+        with session_scope() as session:
+            indexed = search.reindex_videos(session.query(Video).options(*Video.list_options()).all())
+        click.echo(f"Indexed {indexed or 0} videos.")
@@ -1,3 +1,4 @@
+import json
 from os import environ, path
 
 from dotenv import load_dotenv
@@ -30,6 +31,12 @@ class BaseConfig(object):
         'PREVIEW_FOLDER',
         path.join(basedir, "app", "serve", "static", "preview")
     )
+    # Let the front server send media files: "" (serve from Python), "x-accel" or "x-sendfile"
+    MEDIA_OFFLOAD = environ.get("MEDIA_OFFLOAD", "")
+    # For x-accel, maps media directories to internal nginx locations: {"/srv/media/processed": "/_media/processed"}
+    MEDIA_OFFLOAD_LOCATIONS = {
+        path.abspath(k): v for k, v in json.loads(environ.get("MEDIA_OFFLOAD_LOCATIONS", "{}")).items()
+    }
     # APPLICATION_ROOT = "/"
     LOG_INFO_FILE = path.join(basedir, 'log', 'info.log')
     LOG_CELERY_FILE = path.join(basedir, 'log', 'celery.log')
@@ -1,22 +1,29 @@
+import bisect
 import os.path
-import itertools
 
 from celery.utils.log import get_task_logger
 from datetime import datetime
-from imgcompare import is_equal, image_diff_percent
-from PIL import Image
 
 from app import celery
 from app.dl import STATUS_COMPLETED, STATUS_FAILED, STATUS_PROCESSING, STATUS_DOWNLOADING, \
     STATUS_INVALID, STATUS_COOKIES, \
-    original_path, processed_path, thumbnail_path, STATUS_CHECKING
+    original_path, processed_path, STATUS_CHECKING, HLS_PACKAGING
 from app.dl.helpers import seconds_to_time
+from app.dl.duplicates import HashIndex, hash_distance, is_informative, HASH_DISTANCE_THRESHOLD, \
+    FINGERPRINT_MATCH_THRESHOLD, AUDIO_MATCH_THRESHOLD
+from app.dl.features import thumbnail_features, video_fingerprints, audio_fingerprints
+import struct
 import time
 
 
 COMPARE_DURATION_THRESHOLD = 0.15
 COMPARE_RATIO_THRESHOLD = 0.25
 COMPARE_IMAGE_DATA_THRESHOLD = 6.5
+PENDING_RECONCILE_INTERVAL = 900.0
+RELATED_FULL_REFRESH_INTERVAL = 86400.0
+RELATED_REFRESH_DELAY = 5
+RELATED_BATCH_SIZE = 50
+SPRITE_PRUNE_INTERVAL = 86400.0
 
 log = get_task_logger(__name__)
 
@@ -56,31 +63,33 @@ def update_video(video_id: str, status: int, data: dict = {}, pid: int = -1, tas
     return True
 
 
-def check_duplicate_video(v1, v2) -> bool:
+def check_duplicate_video(v1, v2, fingerprint_score: float = None, audio_score: float = None) -> bool:
     try:
         if not (v1.duration and v2.duration):
             return False
         elif abs(1.0 - v1.duration / v2.duration) > COMPARE_DURATION_THRESHOLD:
             return False
-        elif abs(v1.aspect_ratio - v2.aspect_ratio) > COMPARE_RATIO_THRESHOLD:
+
+        # Before the aspect ratio check, reposts with the same audio are often cropped
+        if audio_score is None:
+            audio_score = audio_fingerprints.find(v1.video_id).get(v2.video_id, 0.0)
+        if audio_score >= AUDIO_MATCH_THRESHOLD:
+            return True
+
+        if abs(v1.aspect_ratio - v2.aspect_ratio) > COMPARE_RATIO_THRESHOLD:
             return False
 
-        v1_thumb_path = os.path.join(thumbnail_path, v1.video_id + "_thumb_blurred.jpg")
-        v2_thumb_path = os.path.join(thumbnail_path, v2.video_id + "_thumb_blurred.jpg")
+        if fingerprint_score is None:
+            fingerprint_score = video_fingerprints.score(v1.video_id, [v2.video_id]).get(v2.video_id, 0.0)
+        if fingerprint_score >= FINGERPRINT_MATCH_THRESHOLD:
+            return True
 
-        if os.path.isfile(v1_thumb_path) and os.path.isfile(v2_thumb_path):
-            try:
-                img1 = Image.open(v1_thumb_path)
-                img2 = Image.open(v2_thumb_path)
-                img1 = img1.resize((32, 32))
-                img2 = img2.resize((32, 32))
-                perc = image_diff_percent(img1, img2)
-                return perc < COMPARE_IMAGE_DATA_THRESHOLD
-                # print(perc)
-                # return is_equal(img1, img2, tolerance=COMPARE_IMAGE_DATA_THRESHOLD)
-
-            except Exception as e:
-                log.error(e)
+        if v1.image_hash and v2.image_hash:
+            return hash_distance(v1.image_hash, v2.image_hash) <= HASH_DISTANCE_THRESHOLD
+
+        perc = thumbnail_features.compare(v1.video_id, [v2.video_id]).get(v2.video_id)
+        if perc is not None:
+            return perc < COMPARE_IMAGE_DATA_THRESHOLD
 
     except Exception as e:
         log.error(e)
@@ -93,39 +102,308 @@ def check_all_duplicates_task():
     from app.serve.db import Video, session_scope
     from sqlalchemy import or_
 
+    from sqlalchemy.orm import selectinload
+
     total_duplicates = 0
+    timings = []
     log.info("Checking all videos for duplicates...")
     with session_scope() as session:
-        videos = session.query(Video).filter(or_(
+        stage = time.time()
+        videos = session.query(Video).options(
+            selectinload(Video.duplicates), selectinload(Video.false_positives)
+        ).filter(or_(
             Video.status == STATUS_PROCESSING, Video.status == STATUS_COMPLETED
         )).all()
+        timings.append(("load", time.time() - stage))
+
+        stage = time.time()
+        hashed = sum(1 for v in videos if not v.image_hash and v.update_image_hash())
+        timings.append((f"hash {hashed}", time.time() - stage))
+
+        stage = time.time()
+        index = HashIndex(COMPARE_DURATION_THRESHOLD, COMPARE_RATIO_THRESHOLD)
+        frame_index = HashIndex(COMPARE_DURATION_THRESHOLD, COMPARE_RATIO_THRESHOLD)
+        frames = []
+        for i, v in enumerate(videos):
+            index.add(v.image_hash, v.duration, v.aspect_ratio, i)
+            fingerprint = video_fingerprints.get(v.video_id)
+            frames.append({int(h) for h in fingerprint if is_informative(int(h))} if fingerprint is not None else set())
+            for h in frames[i]:
+                frame_index.add(f"{h:016x}", v.duration, v.aspect_ratio, i)
+        timings.append(("index", time.time() - stage))
 
         log.info(f"There are {len(videos)} videos to test.")
-        for v1, v2 in itertools.combinations(videos, 2):
-            if (v1.can_be_changed and v2.can_be_changed) and check_duplicate_video(v1, v2) and not v2 in v1.false_positives:
-                total_duplicates += 1
-                if v2 not in v1.duplicates:
-                    v1.duplicates.append(v2)
-                if v1 not in v2.duplicates:
-                    v2.duplicates.append(v1)
-            else:
-                if v2 in v1.duplicates:
-                    v1.duplicates.remove(v2)
-                if v1 in v2.duplicates:
-                    v2.duplicates.remove(v1)
-
-            session.add(v1)
-            session.add(v2)
+        stage = time.time()
+        found = {v.id: set() for v in videos}
+        positions = {v.video_id: i for i, v in enumerate(videos)}
+        for i, v1 in enumerate(videos):
+            if not v1.can_be_changed:
+                continue
+            candidates = {j for _distance, j in index.find(v1.image_hash, v1.duration, v1.aspect_ratio) if j > i}
+            for h in frames[i]:
+                candidates.update(j for _distance, j in frame_index.find(f"{h:016x}", v1.duration, v1.aspect_ratio) if j > i)
+            audio_scores = audio_fingerprints.find(v1.video_id)
+            candidates.update(j for j in (positions.get(a) for a in audio_scores) if j is not None and j > i)
+            # One batched alignment for every candidate sharing a frame or the thumbnail
+            scores = video_fingerprints.score(v1.video_id, [videos[j].video_id for j in candidates])
+            for j in candidates:
+                v2 = videos[j]
+                if not v2.can_be_changed or v2 in v1.false_positives:
+                    continue
+                if check_duplicate_video(v1, v2, scores.get(v2.video_id, 0.0), audio_scores.get(v2.video_id, 0.0)):
+                    found[v1.id].add(v2)
+                    found[v2.id].add(v1)
+                    total_duplicates += 1
+        timings.append(("search", time.time() - stage))
+
+        # Without a thumbnail hash the index can't find a video, so those get the pairwise
+        # fallback against every video within the duration window
+        stage = time.time()
+        unhashed = [i for i, v in enumerate(videos) if not v.image_hash]
+        skipped = {videos[i] for i in unhashed if not videos[i].duration or videos[i].duration <= 0}
+        by_duration = sorted((v.duration, j) for j, v in enumerate(videos) if v.duration and v.duration > 0)
+        durations = [d for d, _j in by_duration]
+        for i in unhashed:
+            v1 = videos[i]
+            if v1 in skipped or not v1.can_be_changed:
+                continue
+            window = by_duration[
+                bisect.bisect_left(durations, v1.duration / (1.0 + COMPARE_DURATION_THRESHOLD)):
+                bisect.bisect_right(durations, v1.duration / (1.0 - COMPARE_DURATION_THRESHOLD))
+            ]
+            # Pairs of two unhashed videos are compared once, from the first of them
+            candidates = [
+                j for _d, j in window
+                if j != i and (videos[j].image_hash or j > i) and videos[j] not in found[v1.id]
+            ]
+            scores = video_fingerprints.score(v1.video_id, [videos[j].video_id for j in candidates])
+            audio_scores = audio_fingerprints.find(v1.video_id)
+            for j in candidates:
+                v2 = videos[j]
+                if not v2.can_be_changed or v2 in v1.false_positives or v1 in v2.false_positives:
+                    continue
+                if check_duplicate_video(v1, v2, scores.get(v2.video_id, 0.0), audio_scores.get(v2.video_id, 0.0)):
+                    found[v1.id].add(v2)
+                    found[v2.id].add(v1)
+                    total_duplicates += 1
+        if skipped:
+            log.warning(f"Skipped {len(skipped)} videos without an image hash or duration, kept their links.")
+        timings.append((f"fallback {len(unhashed) - len(skipped)}", time.time() - stage))
+
+        # Only pairs within this set of videos are updated, like the full pairwise check did.
+        # Videos that couldn't be compared keep the links they have.
+        stage = time.time()
+        tested = set(videos) - skipped
+        for v in videos:
+            for d in list(v.duplicates):
+                if v in tested and d in tested and d not in found[v.id]:
+                    v.duplicates.remove(d)
+            for d in found[v.id]:
+                if d not in v.duplicates:
+                    v.duplicates.append(d)
         session.commit()
+        timings.append(("update", time.time() - stage))
 
-    log.info(f"Check is done, found {total_duplicates} duplicates.")
+    log.info(f"Check is done, found {total_duplicates} duplicates. " +
+             ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in timings))
     return total_duplicates
 
 
+@celery.task(name="core.tasks.faststart_archive", soft_time_limit=86400, time_limit=86460, priority=9, queue="processing")
+def faststart_archive_task():
+    """
+        Remuxes every original and processed file that still has its moov atom at the end.
+        Videos that are being downloaded or processed are left alone.
+    """
+    from app.serve.db import Video, session_scope
+    from app.dl.dl import has_faststart, remux_faststart
+
+    with session_scope() as session:
+        video_ids = [v.video_id for v in session.query(Video.video_id).filter(
+            Video.status.notin_([STATUS_DOWNLOADING, STATUS_PROCESSING, STATUS_CHECKING])
+        ).all()]
+
+    dur = time.time()
+    checked, remuxed, failed = 0, 0, 0
+    for video_id in video_ids:
+        for folder in [original_path, processed_path]:
+            p = os.path.join(folder, f"{video_id}.mp4")
+            if not os.path.isfile(p):
+                continue
+            checked += 1
+            try:
+                if has_faststart(p):
+                    continue
+            except (OSError, struct.error) as e:
+                log.error(e)
+                continue
+            if remux_faststart(p):
+                remuxed += 1
+            else:
+                failed += 1
+
+    log.info(f"Faststart check of {checked} files done in {time.time() - dur:.0f} seconds, "
+             f"{remuxed} remuxed and {failed} failed.")
+    return remuxed
+
+
+@celery.task(name="core.tasks.fingerprint_archive", soft_time_limit=86400, time_limit=86460, priority=9, queue="processing")
+def fingerprint_archive_task():
+    """
+        Samples frame and audio fingerprints for completed videos that don't have them yet.
+    """
+    from app.serve.db import Video, session_scope
+    from app.dl.dl import video_fingerprint, audio_fingerprint
+
+    with session_scope() as session:
+        videos = [(v.video_id, v.duration) for v in session.query(Video.video_id, Video.duration).filter(
+            Video.status == STATUS_COMPLETED
+        ).all()]
+
+    dur = time.time()
+    frames, audio = 0, 0
+    for video_id, duration in videos:
+        p = os.path.join(original_path, f"{video_id}.mp4")
+        if not os.path.isfile(p):
+            continue
+        if video_id not in video_fingerprints and video_fingerprints.put(video_id, video_fingerprint(p, duration)):
+            frames += 1
+        # Silent videos are sampled again on every run, there's nothing to index for them
+        if video_id not in audio_fingerprints and audio_fingerprints.add(video_id, audio_fingerprint(p)):
+            audio += 1
+            if audio_fingerprints.needs_merge():
+                audio_fingerprints.merge()
+
+    log.info(f"Added frame fingerprints for {frames} and audio fingerprints for {audio} videos "
+             f"in {time.time() - dur:.0f} seconds.")
+    return frames, audio
+
+
+@celery.task(name="core.tasks.merge_audio_index", soft_time_limit=3600, time_limit=3660, priority=9, queue="processing")
+def merge_audio_index_task():
+    """
+        Folds recently added audio hashes into the sorted index and drops those of removed videos.
+    """
+    dur = time.time()
+    if audio_fingerprints.merge():
+        log.info(f"Merged the audio index in {time.time() - dur:.0f} seconds.")
+
+
+@celery.task(name="core.tasks.reconcile_pending_count", soft_time_limit=60, time_limit=90, priority=9, queue="fast")
+def reconcile_pending_count_task():
+    from app.serve.db import reconcile_pending_counts, session_scope
+
+    with session_scope():
+        counts = reconcile_pending_counts()
+    log.info(f"Reconciled pending counters for {len(counts)} sources.")
+    return counts
+
+
+@celery.task(name="core.tasks.refresh_related_videos", soft_time_limit=3600, time_limit=3660, priority=8, queue="processing")
+def refresh_related_videos_task(video_ids: list = None, expand: bool = True):
+    """
+        Precomputes related videos with batched msearch requests. Without video_ids every
+        video is refreshed, otherwise the given ones, and with expand also the videos
+        that list them or that they now list.
+    """
+    from app.serve.db import Video, session_scope
+    from app.serve.search import recommend_videos_batch, store_related_videos, videos_referencing
+    from sqlalchemy.orm import selectinload
+
+    def refresh(ids) -> dict:
+        related = {}
+        q = session.query(Video).options(selectinload(Video.tags), selectinload(Video.theatres))
+        if ids is None:
+            videos = q.all()
+        else:
+            ids = list(ids)
+            videos = []
+            for i in range(0, len(ids), RELATED_BATCH_SIZE):
+                videos += q.filter(Video.video_id.in_(ids[i:i + RELATED_BATCH_SIZE])).all()
+        for i in range(0, len(videos), RELATED_BATCH_SIZE):
+            batch = recommend_videos_batch(videos[i:i + RELATED_BATCH_SIZE]) or {}
+            store_related_videos(batch)
+            related.update(batch)
+        return related
+
+    dur = time.time()
+    with session_scope() as session:
+        related = refresh(video_ids)
+        total = len(related)
+        if video_ids is not None and expand:
+            affected = videos_referencing(video_ids)
+            for hits in related.values():
+                affected.update(i for i, _score in hits)
+            total += len(refresh(affected - set(video_ids)))
+
+    log.info(f"Refreshed related videos for {total} videos in {time.time() - dur:.1f} seconds.")
+    return total
+
+
+def queue_related_refresh(video_ids: list, expand: bool = True):
+    try:
+        # A handful of videos, these don't need to wait behind post processing
+        refresh_related_videos_task.apply_async(
+            args=[video_ids, expand], countdown=RELATED_REFRESH_DELAY, priority=8, queue="fast"
+        )
+    except Exception as e:
+        log.error(e)
+        log.error("Unable to queue refresh of related videos.")
+
+
+@celery.on_after_configure.connect
+def setup_periodic_tasks(sender, **_kwargs):
+    sender.add_periodic_task(PENDING_RECONCILE_INTERVAL, reconcile_pending_count_task.s(),
+                             name="reconcile pending counters")
+    sender.add_periodic_task(RELATED_FULL_REFRESH_INTERVAL, refresh_related_videos_task.s(),
+                             name="refresh all related videos")
+    sender.add_periodic_task(SPRITE_PRUNE_INTERVAL, prune_sprites_task.s(), name="prune sprite sheets")
+
+
+@celery.task(name="core.tasks.build_sprite", soft_time_limit=120, time_limit=150, priority=0, queue="fast")
+def build_sprite_task(entries: list):
+    from app.serve.sprites import build_sprite
+    try:
+        return build_sprite([tuple(e) for e in entries])
+    except OSError as e:
+        log.error(e)
+        log.error("Unable to build thumbnail sprite sheet.")
+        return ""
+
+
+@celery.task(name="core.tasks.prune_sprites", priority=9, queue="fast")
+def prune_sprites_task():
+    from app.serve.sprites import prune_sprites
+    removed = prune_sprites()
+    log.info(f"Removed {removed} unused sprite sheet files.")
+    return removed
+
+
+@celery.task(name="core.tasks.publish_images", priority=0, queue="fast")
+def publish_images_task(video_ids: list = None, blur_changed: bool = False):
+    """
+        Publishes the versioned thumbnails and previews of the given videos, or every video.
+        With blur_changed the previous versions are removed, they show the wrong images.
+    """
+    from app.serve.db import Video, session_scope
+    from sqlalchemy.orm import selectinload
+
+    changed = 0
+    with session_scope() as session:
+        q = session.query(Video).options(selectinload(Video.tags))
+        if video_ids is not None:
+            q = q.filter(Video.video_id.in_(video_ids))
+        for video in q.all():
+            if video.publish_images(keep_previous=not blur_changed):
+                changed += 1
+    log.info(f"Published new images for {changed} videos.")
+    return changed
+
+
 @celery.task(name="core.tasks.gen_thumbnail", soft_time_limit=300, time_limit=360, priority=0, queue="fast")
 def gen_images_task(metadata: dict):
     from app.dl import original_path, thumbnail_path, preview_path
-    from app.dl.dl import generate_video_images
+    from app.dl.dl import generate_video_images, generate_storyboard, video_fingerprint
     dur = time.time()
     log.info("Generating thumbnail...")
 
@@ -153,6 +431,17 @@ def gen_images_task(metadata: dict):
         desaturate=False,
         content_text=content_warning if content_warning.lower().strip() != "none" else ""
     )
+    publish_images_task(video_ids=[video_id])
+    storyboard_version = generate_storyboard(video_id, vid_save_path, duration)
+    from app.serve.db import Video, session_scope
+    with session_scope() as session:
+        video = session.query(Video).filter_by(video_id=video_id).first()
+        if video:
+            video.update_image_hash()
+            if storyboard_version:
+                video.storyboard_version = storyboard_version
+    thumbnail_features.add_thumbnail(video_id)
+    video_fingerprints.put(video_id, video_fingerprint(vid_save_path, duration))
     dur = time.time() - dur
     _hours, minutes, seconds = seconds_to_time(dur)
     log.info(f"Images generated in {minutes} minutes, {seconds:.2f} seconds: {video_id}")
@@ -226,6 +515,7 @@ def post_process_task(metadata: dict, video_id: str):
                         "processed_bit_rate": data["processed_bit_rate"],
                         "processed_frame_rate": data["processed_frame_rate"],
                         "processed_file_size": data["processed_file_size"],
+                        "renditions": data.get("renditions", ""),
                     })
                     video.from_json(orig_data)
                     session.add(video)
@@ -233,6 +523,20 @@ def post_process_task(metadata: dict, video_id: str):
         except Exception as e:
             log.error(e)
             log.error("Unable to set status to completed on DB row...")
+        if HLS_PACKAGING:
+            from app.dl.dl import package_hls
+            try:
+                version = package_hls(video_id, output_path)
+                if version:
+                    from app.serve.db import Video, session_scope
+                    with session_scope() as session:
+                        video = session.query(Video).filter_by(video_id=video_id).first()
+                        if video:
+                            video.hls_version = version
+                    log.info(f"Packaged HLS stream: {video_id}")
+            except OSError as e:
+                log.error(e)
+                log.error("Unable to package HLS stream...")
         if hours > 0:
             log.info(f"Post-process complete in {hours} hours, {minutes} minutes: {video_id}")
         else:
@@ -247,6 +551,7 @@ def post_process_task(metadata: dict, video_id: str):
                     video.pid = -1
                     video.status = STATUS_COMPLETED
                     video.post_processed = False
+                    video.renditions = ""
                     session.add(video)
                     session.commit()
         except Exception as e:
@@ -313,11 +618,13 @@ def download_task(data: dict, file_name: str):
                 if video:
                     video.task_id = ""
                     video.pid = -1
+                    video.publish_images()
                     if video.status != STATUS_COMPLETED:
                         video.status = STATUS_COMPLETED
                         session.add(video)
                         session.commit()
                     index_video_data(video)
+                    queue_related_refresh([video_id])
         except Exception as e:
             log.error(e)
         if hours > 0:
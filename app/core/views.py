@@ -1,7 +1,6 @@
 import os
 import signal
 import requests
-import redis
 from flask import Blueprint, current_app, request, abort, Response, jsonify
 from flask_login import current_user, login_required
 from flask_limiter import Limiter
@@ -16,7 +15,8 @@ from app.dl import STATUS_DOWNLOADING, STATUS_PENDING, STATUS_FAILED, STATUS_COM
 from app.dl.helpers import unique_filename, remove_emoji, valid_video_url, minimize_url
 from app.dl.metadata import parse_input_data, find_duplicate_video_by_url, get_title_from_html, API_SITES, \
     get_title_from_api, get_description_from_api, get_description_from_source, write_metadata_to_disk
-from app.serve.db import db_session, Video, AUTH_LEVEL_EDITOR
+from app.serve.db import db_session, Video, AUTH_LEVEL_EDITOR, paginate_videos_by_cursor
+from app.extensions import redis_client
 
 core = Blueprint('core', __name__)
 logger = LocalProxy(lambda: current_app.logger)
@@ -25,17 +25,7 @@ limiter = Limiter(
     key_func=get_remote_address,
     default_limits=["1000 per day", "100 per hour"]
 )
-redis_url = os.environ.get("BROKER_URL", "")
-if len(redis_url):
-    redis_url = redis_url.strip("redis://").split(":")[0]
-    try:
-        redis_port = int(redis_url.split(":")[-1])
-    except (ValueError, TypeError):
-        redis_port = 6379
-else:
-    redis_port = -1
-
-redis_client = redis.StrictRedis(host=redis_url, port=redis_port, charset="utf-8", decode_responses=True)
+API_PAGE_SIZE = 50
 
 
 @core.before_request
@@ -93,6 +83,20 @@ def check_if_exists_route():
     return jsonify(urls)
 
 
+@core.route("/videos", methods=["GET"])
+def list_videos_route():
+    size = request.args.get("size", type=int, default=API_PAGE_SIZE)
+    size = max(1, min(size, API_PAGE_SIZE))
+
+    vq = db_session.query(Video).options(*Video.list_options()).filter(Video.visible_to(current_user))
+    videos, next_cursor = paginate_videos_by_cursor(vq, request.args.get("after", ""), size)
+
+    return jsonify({
+        "videos": [v.to_json() for v in videos],
+        "next": next_cursor
+    })
+
+
 @core.route("/desc_from_source/<video_id>")
 @login_required
 @limiter.limit("10/minute", override_defaults=False, exempt_when=lambda: current_user.is_editor)
@@ -1,5 +1,6 @@
 import os
 import logging
+import mimetypes
 from logging.handlers import RotatingFileHandler
 from flask import current_app
 from .helpers import resource_path
@@ -38,6 +39,7 @@ MIN_BIT_RATE_PER_PIXEL = 0.75
 MAX_BIT_RATE_PER_PIXEL = 2.7
 MAX_AUD_BIT_RATE = 128
 MAX_FPS = 60
+RENDITION_HEIGHTS = [1080, 720, 480]
 SPLIT_FPS_THRESHOLD = 40.0
 
 GRAPHIC_TAGS = ["death", "graphic", "violence", "gore", "nudity", "corpses", "blood"]
@@ -70,12 +72,46 @@ media_path = os.environ.get("MEDIA_FOLDER", "")
 original_path = os.path.join(media_path, "original")
 processed_path = os.path.join(media_path, "processed")
 tmp_path = os.path.join(media_path, "tmp")
+hls_path = os.path.join(media_path, "hls")
+image_path = os.path.join(media_path, "images")
+sprite_path = os.path.join(media_path, "sprites")
+storyboard_path = os.path.join(media_path, "storyboards")
+feature_path = os.path.join(media_path, "features")
 json_path = media_path
 
 thumbnail_path = os.environ.get("THUMBNAIL_FOLDER", "")
 preview_path = os.environ.get("PREVIEW_FOLDER", "")
 upload_path = os.environ.get("UPLOAD_FOLDER", "")
 
+# Optional fMP4 HLS packaging of post-processed videos
+HLS_PACKAGING = os.environ.get("HLS_PACKAGING", "").lower() in ("1", "true", "yes")
+HLS_SEGMENT_DURATION = 6
+HLS_PLAYLIST = "index.m3u8"
+# Packaging rewrites the playlist in place, segments are named by the package version
+HLS_PLAYLIST_MAX_AGE = 10
+HLS_SEGMENT_MAX_AGE = 86400
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/iso.segment", ".m4s")
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+# Published thumbnails and previews are named by content and never change
+IMAGE_VERSION_LENGTH = 12
+IMAGE_CACHE_MAX_AGE = 31536000
+# WebP variants are written next to every JPEG image, AVIF too when enabled and Pillow can encode it
+AVIF_IMAGES = os.environ.get("AVIF_IMAGES", "").lower() in ("1", "true", "yes")
+IMAGE_VARIANT_QUALITY = {".webp": 75, ".avif": 55}
+
+# Seek bar storyboards: one tile every STORYBOARD_INTERVAL seconds, spread out on long videos
+STORYBOARD_INTERVAL = 10.0
+STORYBOARD_MAX_TILES = 200
+STORYBOARD_TILE_WIDTH = 160
+STORYBOARD_COLUMNS = 10
+STORYBOARD_BLUR = 0.75
+# Sheets follow the blur decision of the tags, so no shared caches
+STORYBOARD_CACHE_MAX_AGE = 86400
+mimetypes.add_type("text/vtt", ".vtt")
+
 #Logging
 log = logging.getLogger("posterity_dl")
 log.setLevel(logging.DEBUG)
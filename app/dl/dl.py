@@ -1,8 +1,16 @@
 import logging
+import math
+import glob
+import hashlib
 import json
 import os
+import shutil
+import struct
 import subprocess
+import time
 import ffmpeg
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from app import celery
 from tempfile import NamedTemporaryFile
 from PIL import Image, ImageFilter, ImageOps, UnidentifiedImageError, \
@@ -12,16 +20,25 @@ try:
     palette = Palette.ADAPTIVE
 except ImportError:
     palette = Image.ADAPTIVE
+try:
+    import pillow_avif  # Registers the AVIF plugin on Pillow versions without it
+except ImportError:
+    pass
 
 from .youtube import get_content_info, AgeRestrictedError
-from .helpers import valid_video_url
+from .helpers import valid_video_url, IMAGE_VARIANT_TYPES
+from .duplicates import dhash, frame_hashes, audio_peak_hashes, FINGERPRINT_FRAMES, FINGERPRINT_MIN_OVERLAP, \
+    AUDIO_SAMPLE_RATE, AUDIO_MAX_SECONDS
+from .features import thumbnail_features, video_fingerprints, audio_fingerprints
 from .metadata import technical_info, add_technical_info_to_metadata, find_best_format, \
     check_duplicate_for_video, get_frame_count_from_log
 from . import FONT_SIZE_SMALL, FONT_SIZE_MEDIUM, FONT_SIZE_LARGE, CRF, CRF_LOW, \
-    preview_path, thumbnail_path, tmp_path, original_path, \
+    preview_path, thumbnail_path, tmp_path, original_path, processed_path, hls_path, HLS_SEGMENT_DURATION, HLS_PLAYLIST, \
+    image_path, IMAGE_VERSION_LENGTH, AVIF_IMAGES, IMAGE_VARIANT_QUALITY, storyboard_path, \
+    STORYBOARD_INTERVAL, STORYBOARD_MAX_TILES, STORYBOARD_TILE_WIDTH, STORYBOARD_COLUMNS, STORYBOARD_BLUR, \
     STATUS_DOWNLOADING, STATUS_COMPLETED, STATUS_FAILED, STATUS_INVALID, STATUS_COOKIES, STATUS_PROCESSING, \
     MAX_DURATION_HD, MAX_DURATION_MD, MAX_AUD_BIT_RATE, MAX_RESOLUTION_MD, MAX_RESOLUTION_SD, MAX_DURATION_SD, \
-    MAX_FPS, SPLIT_FPS_THRESHOLD, MAX_BIT_RATE_PER_PIXEL, MIN_BIT_RATE_PER_PIXEL, \
+    MAX_FPS, SPLIT_FPS_THRESHOLD, MAX_BIT_RATE_PER_PIXEL, MIN_BIT_RATE_PER_PIXEL, RENDITION_HEIGHTS, \
     GRAPHIC_COLOR, GRAPHIC_GS, GRAPHIC_STROKE_COLOR, GRAPHIC_STROKE_GS, \
     EMOTIONAL_COLOR, EMOTIONAL_GS, EMOTIONAL_STROKE_COLOR, EMOTIONAL_STROKE_GS, \
     FONT_COLOR, FONT_GS, FONT_STROKE_COLOR, FONT_STROKE_GS, \
@@ -72,20 +89,27 @@ def process_from_json_data(metadata: dict, input_file: str, output_file: str) ->
         fps = MAX_FPS
 
     try:
-        pixels = (info["dimensions"][0] * info["dimensions"][1])
+        width, height = info["dimensions"][0], info["dimensions"][1]
+        pixels = width * height
     except (KeyError, IndexError):
+        width, height = 0, 0
         pixels = 921600 * (fps / 30.0)     # 720p
 
-    max_bit_rate = pixels * MAX_BIT_RATE_PER_PIXEL
-    min_bit_rate = pixels * MIN_BIT_RATE_PER_PIXEL
-    r = max_bit_rate - min_bit_rate
-    br = min(1.0, max(0.0, vid_bit_rate - min_bit_rate) / r)
-
-    crf = int(CRF + (CRF_LOW - CRF) * br)
-
-    vid_bit_rate = min(vid_bit_rate, max_bit_rate) // 1000
+    source_bit_rate = vid_bit_rate
+    vid_bit_rate, crf = get_bit_rate_for_pixels(pixels, source_bit_rate)
     aud_bit_rate = min(aud_bit_rate // 1000, MAX_AUD_BIT_RATE)
 
+    # Lower rungs of the ladder, encoded from the same decode as the main output. Rungs of an
+    # earlier run go first, the new ladder may not have the same heights.
+    remove_renditions(output_file)
+    renditions = []
+    for h in RENDITION_HEIGHTS:
+        if not 0 < h < height:
+            continue
+        w = int(round(width * h / height / 2.0)) * 2
+        r_bit_rate, r_crf = get_bit_rate_for_pixels(w * h, source_bit_rate)
+        renditions.append((h, r_bit_rate, r_crf, get_rendition_path(output_file, h)))
+
     log_path = os.path.join(tmp_path, metadata['video_id'] + "_progress.log")
     try:
         open(log_path, "w").close()
@@ -96,7 +120,7 @@ def process_from_json_data(metadata: dict, input_file: str, output_file: str) ->
         input_file, output_file,
         fps=fps, vid_bit_rate=vid_bit_rate,
         aud_bit_rate=aud_bit_rate, crf=crf,
-        log_path=log_path
+        log_path=log_path, renditions=renditions
     )
 
     # metadata["processed_bit_rate"] = (vid_bit_rate + aud_bit_rate) * 1000
@@ -129,14 +153,19 @@ def process_from_json_data(metadata: dict, input_file: str, output_file: str) ->
             log.error(output)
             log.error(errors)
             log.error("Well this all went to shit. Removing video.")
-            try:
-                os.remove(output_file)
-            except (FileNotFoundError, OSError):
-                pass
+            for path in [output_file] + [r[3] for r in renditions]:
+                try:
+                    os.remove(path)
+                except (FileNotFoundError, OSError):
+                    pass
             metadata["status"] = STATUS_FAILED
             break
     else:
         metadata["status"] = STATUS_COMPLETED
+        ensure_faststart(output_file)
+        metadata["renditions"] = json.dumps(
+            [[h, r_bit_rate] for h, r_bit_rate, _crf, path in renditions if os.path.isfile(path)]
+        )
         metadata = add_technical_info_to_metadata(metadata, input_file, post_process=False)
         metadata = add_technical_info_to_metadata(metadata, output_file, post_process=True)
         try:
@@ -292,6 +321,13 @@ def download_from_json_data(metadata: dict, file_name: str):
         except:
             pass
 
+        if valid:
+            ensure_faststart(vid_save_path)
+            audio_fingerprints.add(file_name, audio_fingerprint(vid_save_path))
+            if audio_fingerprints.needs_merge():
+                from app.core.tasks import merge_audio_index_task
+                merge_audio_index_task.delay()
+
         if not valid:
             metadata["status"] = STATUS_FAILED
 
@@ -316,6 +352,10 @@ def download_from_json_data(metadata: dict, file_name: str):
                 log.error("FAILED THUMBNAIL GENERATION")
             else:
                 if success:
+                    metadata["image_hash"] = dhash(os.path.join(thumbnail_path, file_name + "_thumb.jpg"))
+                    thumbnail_features.add_thumbnail(file_name)
+                    video_fingerprints.put(file_name, video_fingerprint(vid_save_path, duration))
+                    metadata["storyboard_version"] = generate_storyboard(file_name, vid_save_path, duration)
                     log.info("Checking for duplicates")
                     duplicates = check_duplicate_for_video(file_name)
                     if duplicates:
@@ -352,10 +392,194 @@ def validate_video_file(
         return False
 
 
+def has_faststart(video_path: str) -> bool:
+    """
+        True if the moov atom comes before mdat, so playback can start from the first bytes.
+    """
+    with open(video_path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, atom = struct.unpack(">I4s", header)
+            if atom == b"moov":
+                return True
+            elif atom == b"mdat":
+                return False
+            if size == 1:
+                extended = f.read(8)
+                if len(extended) < 8:
+                    return False
+                size = struct.unpack(">Q", extended)[0]
+                if size < 16:
+                    return False
+                size -= 16
+            elif size < 8:
+                # 0 runs to the end of the file, anything else up to 7 is a broken header
+                return False
+            else:
+                size -= 8
+            f.seek(size, os.SEEK_CUR)
+
+
+def remux_faststart(video_path: str, log_path: str = "/dev/null") -> bool:
+    """
+        Moves the moov atom to the front with a stream copy, replacing the file atomically.
+    """
+    tmp_file = os.path.join(os.path.dirname(video_path), "." + os.path.basename(video_path) + ".faststart.mp4")
+    result = subprocess.Popen(
+        ["ffmpeg", "-y", "-i", video_path, "-map", "0", "-c", "copy", "-movflags", "+faststart",
+         "-progress", log_path, "-v", "24", tmp_file],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    output, errors = result.communicate()
+    if result.returncode != 0 or not os.path.isfile(tmp_file):
+        log.error(output)
+        log.error(errors)
+        log.error(f"Unable to remux {video_path} for faststart.")
+        try:
+            os.remove(tmp_file)
+        except (FileNotFoundError, OSError):
+            pass
+        return False
+    os.replace(tmp_file, video_path)
+    return True
+
+
+def ensure_faststart(video_path: str) -> bool:
+    try:
+        if has_faststart(video_path):
+            return True
+    except (OSError, struct.error) as e:
+        log.error(e)
+        return False
+    log.info(f"Moving moov atom to the front of {video_path}")
+    return remux_faststart(video_path)
+
+
+def get_bit_rate_for_pixels(pixels: float, source_bit_rate: float) -> (int, int):
+    """
+        Target video bit rate (kbps) and CRF for a frame size, from the bit rate per pixel
+        model and the bit rate of the source.
+    """
+    max_bit_rate = pixels * MAX_BIT_RATE_PER_PIXEL
+    min_bit_rate = pixels * MIN_BIT_RATE_PER_PIXEL
+    r = max_bit_rate - min_bit_rate
+    br = min(1.0, max(0.0, source_bit_rate - min_bit_rate) / r)
+
+    crf = int(CRF + (CRF_LOW - CRF) * br)
+    return int(min(source_bit_rate, max_bit_rate) // 1000), crf
+
+
+def get_rendition_path(output_path: str, height: int) -> str:
+    return f"{os.path.splitext(output_path)[0]}_{height}p.mp4"
+
+
+def remove_renditions(output_path: str):
+    for path in glob.glob(f"{glob.escape(os.path.splitext(output_path)[0])}_[0-9]*p.mp4"):
+        try:
+            os.remove(path)
+        except OSError as e:
+            log.error(e)
+
+
+def get_hls_ffmpeg_cmd(input_path: str, output_dir: str, version: str, segment_duration: int = HLS_SEGMENT_DURATION,
+                       log_path: str = "/dev/null") -> list:
+    return [
+        "ffmpeg", "-y", "-i", input_path,
+        "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy",
+        "-f", "hls", "-hls_time", str(segment_duration), "-hls_playlist_type", "vod",
+        "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", f"init_{version}.mp4",
+        "-hls_segment_filename", os.path.join(output_dir, f"seg_{version}_%05d.m4s"),
+        "-progress", log_path, "-v", "24", os.path.join(output_dir, HLS_PLAYLIST)
+    ]
+
+
+def package_hls(video_id: str, input_path: str) -> str:
+    """
+        Packages a (post-processed) video as fMP4 HLS with stream copy. The segments are
+        written to a temporary directory which then replaces hls_path/<video_id>. Returns
+        the version in the segment names, empty on failure.
+    """
+    version = f"{int(time.time()):x}"
+    out_dir = os.path.join(hls_path, video_id)
+    tmp_dir = os.path.join(hls_path, f".{video_id}.tmp")
+    old_dir = os.path.join(hls_path, f".{video_id}.old")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    result = subprocess.Popen(
+        get_hls_ffmpeg_cmd(input_path, tmp_dir, version), stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    output, errors = result.communicate()
+    if result.returncode != 0 or not os.path.isfile(os.path.join(tmp_dir, HLS_PLAYLIST)):
+        log.error(output)
+        log.error(errors)
+        log.error(f"HLS packaging failed for {video_id}.")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return ""
+
+    if os.path.isdir(out_dir):
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return version
+
+
+def remove_derived_media(video_id: str):
+    """
+        Removes the files generated from a video, which can all be made again from the original.
+    """
+    shutil.rmtree(os.path.join(hls_path, video_id), ignore_errors=True)
+    remove_renditions(os.path.join(processed_path, video_id + ".mp4"))
+    thumbnail_features.remove(video_id)
+    video_fingerprints.remove(video_id)
+    audio_fingerprints.remove(video_id)
+    for path in glob.glob(os.path.join(storyboard_path, glob.escape(video_id) + "[._]*")):
+        try:
+            os.remove(path)
+        except OSError as e:
+            log.error(e)
+    for path in glob.glob(os.path.join(image_path, glob.escape(video_id) + "_*")):
+        try:
+            os.remove(path)
+        except OSError as e:
+            log.error(e)
+
+
 def get_post_process_ffmpeg_cmd(
         input_path: str, output_path: str, queue_size=512,
-        fps=25, vid_bit_rate=2000, aud_bit_rate=128, crf=CRF, log_path="/dev/null"
+        fps=25, vid_bit_rate=2000, aud_bit_rate=128, crf=CRF, log_path="/dev/null", renditions: list = None
     ) -> list:
+    """
+        renditions: (height, vid_bit_rate, crf, path) for extra outputs, scaled from the same
+        decoded and filtered frames with the split filter.
+    """
+    if renditions:
+        filters = f"[0:v]yadif=parity=auto,fps={fps},split={len(renditions) + 1}[main]"
+        filters += "".join(f"[r{i}]" for i in range(len(renditions)))
+        for i, (height, _br, _crf, _path) in enumerate(renditions):
+            filters += f";[r{i}]scale=-2:{height}[r{i}out]"
+
+        cmd = [
+            "ffmpeg", "-thread_queue_size", f"{queue_size}", "-y",
+            "-vsync", "vfr",
+            "-i", input_path,
+            "-filter_complex", filters,
+            "-progress", log_path, "-v", "34",
+        ]
+        outputs = [("[main]", vid_bit_rate, crf, output_path)]
+        outputs += [(f"[r{i}out]", r[1], r[2], r[3]) for i, r in enumerate(renditions)]
+        for label, br, out_crf, path in outputs:
+            cmd += [
+                "-map", label, "-map", "0:a?",
+                "-c:v", "libx264", "-pix_fmt", "yuv420p", "-vprofile", "main", "-vlevel", "4", "-preset", "veryslow",
+                "-b:v", f"{br}k", "-crf", str(out_crf),
+                "-c:a", "aac", "-strict", "experimental", "-b:a", f"{aud_bit_rate}k",
+                "-movflags", "+faststart", path
+            ]
+        return cmd
 
     pass_1 = [
         "ffmpeg", "-thread_queue_size", f"{queue_size}", "-y",
@@ -364,6 +588,7 @@ def get_post_process_ffmpeg_cmd(
         "-c:v", "libx264", "-filter:v", f"yadif=parity=auto[v];[v]fps={fps}", "-pix_fmt", "yuv420p", "-vprofile", "main", "-vlevel", "4", "-preset", "veryslow",
         "-b:v", f"{vid_bit_rate}k", "-crf", str(crf),
         "-c:a", "aac", "-strict", "experimental", "-b:a", f"{aud_bit_rate}k",
+        "-movflags", "+faststart",
         "-progress", log_path, "-v", "34", output_path
     ]
 
@@ -393,7 +618,7 @@ def get_ffmpeg_cmd(
         # dynamic norm
         cmd += ["-af", "dynaudnorm=p=0.85"]
 
-    cmd += ["-vcodec", "libx264", "-crf", str(crf), "-f", "mp4"]
+    cmd += ["-vcodec", "libx264", "-crf", str(crf), "-f", "mp4", "-movflags", "+faststart"]
 
     if http_persistent:
         cmd += ["-http_persistent", "1"]
@@ -558,6 +783,10 @@ def generate_video_images(
         preview_blurred.save(blurred_preview_path, optimize=True, quality=85)
         thumb.save(thumb_out_path, optimize=True, quality=60)
         thumb_blurred.save(blurred_thumb_path, optimize=True, quality=60)
+        save_image_variants(preview, preview_out_path, 90)
+        save_image_variants(preview_blurred, blurred_preview_path, 85)
+        save_image_variants(thumb, thumb_out_path, 60)
+        save_image_variants(thumb_blurred, blurred_thumb_path, 60)
     except (PermissionError, IOError, FileExistsError) as e:
         log.error(e)
         return False
@@ -565,6 +794,260 @@ def generate_video_images(
     return True
 
 
+def get_storyboard_ffmpeg_cmd(input_path: str, output_path: str, interval: float, columns: int, rows: int) -> list:
+    return [
+        "ffmpeg", "-y", "-loglevel", "error", "-i", input_path, "-an", "-sn",
+        "-vf", f"fps=1/{interval:.3f},scale={STORYBOARD_TILE_WIDTH}:-2,tile={columns}x{rows}",
+        "-frames:v", "1", "-q:v", "5", output_path
+    ]
+
+
+def vtt_timestamp(t: float) -> str:
+    hours, rest = divmod(t, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+
+def generate_storyboard(video_id: str, video_path: str, duration: float) -> str:
+    """
+        Tiles a frame every STORYBOARD_INTERVAL seconds into one image with a single decode and
+        writes a WebVTT thumbnails track pointing into it, for seek bar previews, along with a
+        sheet of blurred tiles. Returns the version in the track's urls, empty on failure.
+    """
+    if not duration or duration <= 0:
+        return ""
+    version = f"{int(time.time()):x}"
+    interval = max(STORYBOARD_INTERVAL, duration / STORYBOARD_MAX_TILES)
+    count = max(1, math.ceil(duration / interval))
+    columns = min(count, STORYBOARD_COLUMNS)
+    rows = math.ceil(count / columns)
+
+    os.makedirs(storyboard_path, exist_ok=True)
+    tmp_image = os.path.join(storyboard_path, f".{video_id}.tmp.jpg")
+    tmp_blurred = os.path.join(storyboard_path, f".{video_id}_blurred.tmp.jpg")
+    tmp_track = os.path.join(storyboard_path, f".{video_id}.tmp.vtt")
+    try:
+        result = subprocess.run(
+            get_storyboard_ffmpeg_cmd(video_path, tmp_image, interval, columns, rows),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        if result.returncode != 0:
+            log.error(result.stdout)
+            log.error(f"Storyboard generation failed for {video_id}.")
+            return ""
+        try:
+            with Image.open(tmp_image) as img:
+                tile_width, tile_height = img.size[0] // columns, img.size[1] // rows
+                # Tile by tile, so the blur doesn't bleed across neighbouring frames
+                blurred = img.convert("RGB")
+                for i in range(count):
+                    box = ((i % columns) * tile_width, (i // columns) * tile_height)
+                    box += (box[0] + tile_width, box[1] + tile_height)
+                    tile = blurred.crop(box).filter(ImageFilter.GaussianBlur(tile_width / 16 * STORYBOARD_BLUR))
+                    blurred.paste(tile, box)
+                blurred.save(tmp_blurred, quality=70)
+        except (OSError, UnidentifiedImageError) as e:
+            log.error(e)
+            log.error(f"Storyboard generation failed for {video_id}.")
+            return ""
+
+        cues = ["WEBVTT", ""]
+        for i in range(count):
+            x, y = (i % columns) * tile_width, (i // columns) * tile_height
+            cues.append(f"{vtt_timestamp(i * interval)} --> {vtt_timestamp(min((i + 1) * interval, duration))}")
+            cues.append(f"/storyboard/{video_id}.jpg?v={version}#xywh={x},{y},{tile_width},{tile_height}")
+            cues.append("")
+        try:
+            with open(tmp_track, "w") as f:
+                f.write("\n".join(cues))
+            os.replace(tmp_image, os.path.join(storyboard_path, video_id + ".jpg"))
+            os.replace(tmp_blurred, os.path.join(storyboard_path, video_id + "_blurred.jpg"))
+            os.replace(tmp_track, os.path.join(storyboard_path, video_id + ".vtt"))
+        except OSError as e:
+            log.error(e)
+            log.error(f"Unable to write the storyboard of {video_id}.")
+            return ""
+        return version
+    finally:
+        for path in (tmp_image, tmp_blurred, tmp_track):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def get_fingerprint_ffmpeg_cmd(input_path: str, duration: float, frames: int = FINGERPRINT_FRAMES) -> list:
+    return [
+        "ffmpeg", "-loglevel", "error", "-i", input_path, "-an", "-sn",
+        "-vf", f"fps={frames / duration:.6f},scale=9:8:flags=area,format=gray",
+        "-frames:v", str(frames), "-f", "rawvideo", "-pix_fmt", "gray", "pipe:1"
+    ]
+
+
+def video_fingerprint(video_path: str, duration: float):
+    """
+        dHashes of FINGERPRINT_FRAMES frames spread evenly over the video, scaled down to
+        9x8 gray by ffmpeg in one decode. None if too few frames could be read.
+    """
+    if not duration or duration <= 0:
+        return None
+    result = subprocess.run(
+        get_fingerprint_ffmpeg_cmd(video_path, duration),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    hashes = frame_hashes(result.stdout)
+    if len(hashes) < FINGERPRINT_MIN_OVERLAP:
+        log.error(result.stderr)
+        log.error(f"Fingerprint failed for {video_path}.")
+        return None
+    # Rounding in the fps filter can leave a frame short, repeat the last one
+    hashes = np.concatenate([hashes, np.repeat(hashes[-1:], max(0, FINGERPRINT_FRAMES - len(hashes)))])
+    return hashes[:FINGERPRINT_FRAMES]
+
+
+def get_audio_fingerprint_ffmpeg_cmd(input_path: str) -> list:
+    return [
+        "ffmpeg", "-loglevel", "error", "-i", input_path, "-vn", "-sn", "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE),
+        "-t", str(AUDIO_MAX_SECONDS), "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1"
+    ]
+
+
+def audio_fingerprint(video_path: str):
+    """
+        Peak hashes of the audio decoded to mono PCM by ffmpeg, None for silent videos.
+    """
+    result = subprocess.run(
+        get_audio_fingerprint_ffmpeg_cmd(video_path),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    # Videos without an audio stream make ffmpeg fail without output
+    if not result.stdout:
+        return None
+    return audio_peak_hashes(np.frombuffer(result.stdout[:len(result.stdout) // 2 * 2], dtype="<i2"))
+
+
+def build_sprite_sheet(sources: list, out_path: str, tile_size: int = 64) -> list:
+    """
+        Stacks the images in a single column of tile_size cells and saves the sheet (with
+        variants) to out_path. Returns each tile's (y, width, height) in order.
+    """
+    sheet = Image.new("RGB", (tile_size, tile_size * max(1, len(sources))), (32, 32, 32))
+    tiles = []
+    for i, p in enumerate(sources):
+        try:
+            with Image.open(p) as img:
+                img.thumbnail((tile_size, tile_size))
+                sheet.paste(img.convert("RGB"), (0, i * tile_size))
+                tiles.append((i * tile_size, img.size[0], img.size[1]))
+        except (OSError, UnidentifiedImageError) as e:
+            log.error(e)
+            tiles.append((i * tile_size, tile_size, tile_size))
+
+    base, ext = os.path.splitext(out_path)
+    tmp_path = f"{base}.{os.getpid()}.tmp{ext}"
+    sheet.save(tmp_path, optimize=True, quality=70)
+    save_image_variants(sheet, tmp_path, 70)
+    for variant in image_variant_extensions():
+        os.replace(os.path.splitext(tmp_path)[0] + variant, base + variant)
+    os.replace(tmp_path, out_path)
+    return tiles
+
+
+def image_variant_extensions() -> list:
+    extensions = [".webp"]
+    if AVIF_IMAGES and ".avif" in Image.registered_extensions():
+        extensions.append(".avif")
+    return extensions
+
+
+def save_image_variants(img, jpeg_path: str, quality: int):
+    """
+        Writes the WebP (and AVIF) variants of an image next to its JPEG, at no higher quality.
+    """
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    base = os.path.splitext(jpeg_path)[0]
+    for ext in image_variant_extensions():
+        img.save(base + ext, quality=min(quality, IMAGE_VARIANT_QUALITY[ext]))
+
+
+def convert_image_variants(jpeg_path: str) -> bool:
+    """
+        Writes the missing variants of an existing JPEG image.
+    """
+    base = os.path.splitext(jpeg_path)[0]
+    if all(os.path.isfile(base + ext) for ext in image_variant_extensions()):
+        return False
+    try:
+        with Image.open(jpeg_path) as img:
+            img.load()
+            quality = 60 if "_thumb" in os.path.basename(jpeg_path) else 85
+            save_image_variants(img, jpeg_path, quality)
+    except (OSError, UnidentifiedImageError) as e:
+        log.error(e)
+        return False
+    return True
+
+
+def convert_all_image_variants(workers: int = None) -> int:
+    """
+        Backfills WebP/AVIF variants for the archive's thumbnails and previews in a process
+        pool. Not a Celery task as pool workers can't fork, the backfill-images command runs
+        it and publishes the results.
+    """
+    paths = []
+    for folder in {thumbnail_path, preview_path}:
+        paths += [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".jpg")]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        converted = sum(pool.map(convert_image_variants, paths, chunksize=32))
+    log.info(f"Converted {converted} of {len(paths)} images.")
+    return converted
+
+
+def publish_video_images(video_id: str, blur: bool, keep_previous: bool = True) -> str:
+    """
+        Copies the thumbnail and preview to show, blurred or clear, to the image folder under
+        names carrying a hash of their content, so they can be served as immutable static files.
+        Returns the version, or an empty string if the images haven't been generated.
+        The previous version is kept for pages that are still cached with it, unless the blur
+        decision changed and it would show what shouldn't be shown.
+    """
+    sources = []
+    for kind, folder in (("thumb", thumbnail_path), ("preview", preview_path)):
+        blurred = os.path.join(folder, f"{video_id}_{kind}_blurred.jpg")
+        sources.append((kind, blurred if blur and os.path.isfile(blurred) else os.path.join(folder, f"{video_id}_{kind}.jpg")))
+    if not all(os.path.isfile(p) for _kind, p in sources):
+        return ""
+
+    digest = hashlib.sha1()
+    for _kind, p in sources:
+        with open(p, "rb") as f:
+            digest.update(f.read())
+    version = digest.hexdigest()[:IMAGE_VERSION_LENGTH]
+
+    os.makedirs(image_path, exist_ok=True)
+    for kind, p in sources:
+        base = os.path.splitext(p)[0]
+        for ext in [".jpg"] + list(IMAGE_VARIANT_TYPES):
+            out_path = os.path.join(image_path, f"{video_id}_{kind}_{version}{ext}")
+            if os.path.isfile(base + ext) and not os.path.isfile(out_path):
+                # Copied rather than linked, the source is overwritten in place when regenerated
+                shutil.copyfile(base + ext, out_path + ".tmp")
+                os.replace(out_path + ".tmp", out_path)
+
+        old = {}
+        for f in glob.glob(os.path.join(image_path, f"{video_id}_{kind}_*")):
+            v = os.path.basename(f)[len(f"{video_id}_{kind}_"):].split(".")[0]
+            if v != version:
+                old.setdefault(v, []).append(f)
+        for v in sorted(old, key=lambda v: max(map(os.path.getmtime, old[v])))[:-1 if keep_previous else None]:
+            for f in old[v]:
+                try:
+                    os.remove(f)
+                except OSError as e:
+                    log.error(e)
+    return version
+
+
 def generate_logo(
         orig_path: str, width=96, height=32
 ):
@@ -586,6 +1069,7 @@ def generate_all_images(
         if file_name.endswith(".mp4"):
             videos.append((file_name.split(".mp4")[0], os.path.join(orig_path, file_name)))
 
+    storyboards = {}
     for (video_id, video_path) in videos:
         info = technical_info(video_path)
 
@@ -612,9 +1096,18 @@ def generate_all_images(
             desaturate=False,
             content_text=content_text
         )
+        if success:
+            thumbnail_features.add_thumbnail(video_id)
+            video_fingerprints.put(video_id, video_fingerprint(video_path, info["duration"]))
+            storyboards[video_id] = generate_storyboard(video_id, video_path, info["duration"])
         if not success:
             log.error(f"Failed generating images for {video_id}")
 
+    from app.serve.db import Video, session_scope
+    with session_scope() as session:
+        for video in session.query(Video).filter(Video.video_id.in_([i for i, v in storyboards.items() if v])):
+            video.storyboard_version = storyboards[video.video_id]
+
 
 
 if __name__ == "__main__":
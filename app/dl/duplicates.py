@@ -0,0 +1,221 @@
+"""
+    Perceptual hashes and lookup structures for finding duplicate videos without comparing
+    every pair of thumbnails.
+"""
+import math
+from collections import defaultdict
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+
+HASH_SIZE = 8
+HASH_DISTANCE_THRESHOLD = 10
+
+# Frame hash sequences sampled evenly across each video
+FINGERPRINT_FRAMES = 16
+FINGERPRINT_MAX_SHIFT = 4
+FINGERPRINT_MIN_OVERLAP = 8
+FINGERPRINT_MATCH_THRESHOLD = 0.75
+
+# Audio peak hashes from mono PCM, frames of AUDIO_WINDOW samples every AUDIO_HOP (64 ms)
+AUDIO_SAMPLE_RATE = 8000
+AUDIO_WINDOW = 1024
+AUDIO_HOP = 512
+AUDIO_MAX_SECONDS = 600
+AUDIO_PEAKS_PER_SECOND = 4
+AUDIO_PEAK_TIME_RANGE = 7
+AUDIO_PEAK_FREQ_RANGE = 10
+AUDIO_PEAK_FLOOR = 0.25  # Around -60 dBFS, keeps silence and hiss from producing peaks
+AUDIO_FAN_OUT = 4
+AUDIO_MAX_DT = 63
+AUDIO_MIN_MATCHES = 20
+AUDIO_MATCH_THRESHOLD = 0.2
+
+
+def dhash(image_path: str) -> str:
+    """
+        64-bit difference hash of an image as 16 hex digits, empty if it can't be read.
+    """
+    try:
+        with Image.open(image_path) as img:
+            img = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+            pixels = list(img.getdata())
+    except (OSError, UnidentifiedImageError):
+        return ""
+
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            i = row * (HASH_SIZE + 1) + col
+            bits = (bits << 1) | (pixels[i] > pixels[i + 1])
+    return f"{bits:016x}"
+
+
+def frame_hashes(raw: bytes) -> np.ndarray:
+    """
+        dHashes of raw 9x8 grayscale frames, one uint64 per frame.
+    """
+    frames = np.frombuffer(raw, dtype=np.uint8)
+    frames = frames[:len(frames) // 72 * 72].reshape(-1, HASH_SIZE, HASH_SIZE + 1)
+    bits = (frames[:, :, :-1] > frames[:, :, 1:]).reshape(-1, 64)
+    return np.packbits(bits, axis=1).view(">u8").astype(np.uint64).reshape(-1)
+
+
+def fingerprint_scores(fingerprint: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """
+        Best alignment of a frame hash sequence against each row of others: the share of
+        overlapping frames within HASH_DISTANCE_THRESHOLD, over shifts of up to
+        FINGERPRINT_MAX_SHIFT frames, which covers an added or cut intro.
+    """
+    if not len(others):
+        return np.zeros(0)
+    xor = np.bitwise_xor(others[:, None, :], fingerprint[None, :, None])
+    distances = np.unpackbits(xor.view(np.uint8), axis=-1).reshape(xor.shape + (64,)).sum(axis=-1)
+    # Flat frames only count against a match
+    bit_counts = np.unpackbits(fingerprint.view(np.uint8)).reshape(-1, 64).sum(axis=-1)
+    informative = (bit_counts >= 4) & (bit_counts <= 60)
+    matches = (distances <= HASH_DISTANCE_THRESHOLD) & informative[None, :, None]
+
+    best = np.zeros(len(others))
+    for shift in range(-FINGERPRINT_MAX_SHIFT, FINGERPRINT_MAX_SHIFT + 1):
+        aligned = np.diagonal(matches, offset=shift, axis1=1, axis2=2)
+        if aligned.shape[-1] >= FINGERPRINT_MIN_OVERLAP:
+            best = np.maximum(best, aligned.mean(axis=-1))
+    return best
+
+
+def _max_filter(a: np.ndarray, size: int, axis: int) -> np.ndarray:
+    pad = [(0, 0)] * a.ndim
+    pad[axis] = (size, size)
+    padded = np.pad(a, pad, constant_values=-np.inf)
+    return np.lib.stride_tricks.sliding_window_view(padded, 2 * size + 1, axis=axis).max(axis=-1)
+
+
+def audio_peak_hashes(samples: np.ndarray):
+    """
+        Landmark hashes of mono 16-bit PCM at AUDIO_SAMPLE_RATE: the strongest spectrogram
+        peaks of every second, each paired with the next AUDIO_FAN_OUT peaks into a 32-bit
+        hash of both frequencies and their distance in frames. Returns the hashes and the
+        frame of their first peak, None if there are too few for a reliable match.
+    """
+    samples = samples[:AUDIO_SAMPLE_RATE * AUDIO_MAX_SECONDS].astype(np.float32) / 32768.0
+    if len(samples) < AUDIO_WINDOW:
+        return None
+    count = 1 + (len(samples) - AUDIO_WINDOW) // AUDIO_HOP
+    frames = np.lib.stride_tricks.as_strided(
+        samples, shape=(count, AUDIO_WINDOW), strides=(samples.strides[0] * AUDIO_HOP, samples.strides[0])
+    )
+    # Without the DC bin, leaving 512 frequencies that fit in 9 bits
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(AUDIO_WINDOW), axis=1))[:, 1:]
+
+    local_max = _max_filter(_max_filter(spectrum, AUDIO_PEAK_FREQ_RANGE, 1), AUDIO_PEAK_TIME_RANGE, 0)
+    times, freqs = np.nonzero((spectrum == local_max) & (spectrum > AUDIO_PEAK_FLOOR))
+    if not len(times):
+        return None
+
+    # The strongest few of each second, so loud passages don't crowd out the rest
+    seconds = times * AUDIO_HOP // AUDIO_SAMPLE_RATE
+    order = np.lexsort((-spectrum[times, freqs], seconds))
+    rank = np.arange(len(order)) - np.searchsorted(seconds[order], seconds[order])
+    keep = np.sort(order[rank < AUDIO_PEAKS_PER_SECOND])
+    times, freqs = times[keep], freqs[keep]
+
+    hashes, offsets = [], []
+    for step in range(1, AUDIO_FAN_OUT + 1):
+        dt = times[step:] - times[:-step]
+        valid = (dt > 0) & (dt <= AUDIO_MAX_DT)
+        anchors = np.flatnonzero(valid)
+        hashes.append((freqs[anchors].astype(np.uint32) << 15) | (freqs[anchors + step].astype(np.uint32) << 6)
+                      | dt[valid].astype(np.uint32))
+        offsets.append(times[anchors].astype(np.uint16))
+    hashes, offsets = np.concatenate(hashes), np.concatenate(offsets)
+    if len(hashes) < AUDIO_MIN_MATCHES:
+        return None
+    return hashes, offsets
+
+
+def is_informative(h: int) -> bool:
+    # Flat frames (black, white, fades) hash to nearly all zeros or ones and match anything
+    return 4 <= bin(h).count("1") <= 60
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def hash_distance(a: str, b: str) -> int:
+    return hamming(int(a, 16), int(b, 16))
+
+
+class BKTree(object):
+    """
+        Burkhard-Keller tree over hamming distance. Finds every item within a distance of a
+        hash while skipping the subtrees the triangle inequality rules out.
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, h: int, item):
+        node = (h, item, {})
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            d = hamming(h, current[0])
+            child = current[2].get(d)
+            if child is None:
+                current[2][d] = node
+                return
+            current = child
+
+    def find(self, h: int, max_distance: int) -> list:
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_hash, item, children = stack.pop()
+            d = hamming(h, node_hash)
+            if d <= max_distance:
+                found.append((d, item))
+            for child_distance, child in children.items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    stack.append(child)
+        return found
+
+
+class HashIndex(object):
+    """
+        BK-trees of perceptual hashes, one per bucket of similar duration and aspect ratio.
+        Buckets are as wide as the thresholds, so any match is in the same or a neighbouring
+        bucket; callers still check the exact thresholds on what's found.
+    """
+    def __init__(self, duration_threshold: float, ratio_threshold: float):
+        self.duration_width = math.log(1.0 / (1.0 - duration_threshold))
+        self.ratio_width = ratio_threshold
+        self.buckets = defaultdict(BKTree)
+
+    def key(self, duration: float, aspect_ratio: float) -> tuple:
+        return int(math.log(duration) // self.duration_width), int(aspect_ratio // self.ratio_width)
+
+    def add(self, image_hash: str, duration: float, aspect_ratio: float, item) -> bool:
+        if not image_hash or not duration or duration <= 0:
+            return False
+        self.buckets[self.key(duration, aspect_ratio)].add(int(image_hash, 16), item)
+        return True
+
+    def find(self, image_hash: str, duration: float, aspect_ratio: float,
+             max_distance: int = HASH_DISTANCE_THRESHOLD) -> list:
+        if not image_hash or not duration or duration <= 0:
+            return []
+        h = int(image_hash, 16)
+        d_key, r_key = self.key(duration, aspect_ratio)
+        found = []
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                bucket = self.buckets.get((d_key + i, r_key + j))
+                if bucket:
+                    found += bucket.find(h, max_distance)
+        return found
@@ -0,0 +1,557 @@
+"""
+    Memory-mapped stores of per-video feature rows (small grayscale thumbnails, frame hash
+    fingerprints) and an inverted index of audio hashes, so duplicate checks compare a video
+    against its candidates in one vectorized operation instead of decoding images or video.
+"""
+import fcntl
+import json
+import logging
+import os
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+from . import feature_path, thumbnail_path
+from .duplicates import fingerprint_scores, FINGERPRINT_FRAMES, AUDIO_MIN_MATCHES
+
+
+FEATURE_SIZE = 32
+FEATURE_LENGTH = FEATURE_SIZE * FEATURE_SIZE
+
+AUDIO_RECORD = np.dtype([("hash", "<u4"), ("video", "<u4"), ("offset", "<u2")])
+# Records past the sorted copy, or of removed videos, before a merge is due
+AUDIO_MERGE_RECORDS = 1 << 20
+
+log = logging.getLogger("posterity_dl")
+
+
+def image_vector(image_path: str):
+    """
+        The image as a flat FEATURE_SIZE x FEATURE_SIZE grayscale uint8 vector, None if unreadable.
+    """
+    try:
+        with Image.open(image_path) as img:
+            img = img.convert("L").resize((FEATURE_SIZE, FEATURE_SIZE), Image.BILINEAR)
+            return np.asarray(img, dtype=np.uint8).reshape(-1)
+    except (OSError, UnidentifiedImageError):
+        return None
+
+
+def _replace_json(path: str, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class FeatureStore(object):
+    """
+        One fixed-length row per video in a flat file read through np.memmap. Which row
+        belongs to which video is kept in an append-only log of "<video_id>\t<row>" lines,
+        "<video_id>\t" for a removed video and "\t<row>" for a free row. Writers append
+        under a file lock and rewrite the log once most of it is stale; readers only parse
+        what was appended since their last look and start over when the log was rewritten.
+        Rows of removed videos are reused by the next videos that are added.
+    """
+    def __init__(self, folder: str, name: str, length: int, dtype=np.uint8):
+        self.folder = folder
+        self.length = length
+        self.dtype = np.dtype(dtype)
+        self.row_size = length * self.dtype.itemsize
+        self.data_path = os.path.join(folder, f"{name}.u{self.dtype.itemsize * 8}")
+        self.log_path = os.path.join(folder, name + ".log")
+        # The JSON index of earlier versions, turned into the log by the first writer
+        self.index_path = os.path.join(folder, name + ".json")
+        self.lock_path = os.path.join(folder, name + ".lock")
+        self._reset()
+
+    def _reset(self):
+        self._index = {}
+        self._free = set()
+        self._log_inode = None
+        self._log_position = 0
+        self._log_lines = 0
+        self._data_size = None
+        self._matrix = None
+
+    def _apply(self, lines: list):
+        for line in lines:
+            video_id, _tab, row = line.partition("\t")
+            if not video_id:
+                self._free.add(int(row))
+            elif not row:
+                if video_id in self._index:
+                    self._free.add(self._index.pop(video_id))
+            else:
+                self._index[video_id] = int(row)
+                self._free.discard(int(row))
+        self._log_lines += len(lines)
+
+    def _load(self):
+        try:
+            stat = os.stat(self.log_path)
+        except OSError:
+            if self._log_inode is not None or self._data_size is None:
+                self._reset()
+                try:
+                    with open(self.index_path) as f:
+                        self._apply([f"{i}\t{r}" for i, r in json.load(f).items()])
+                except (OSError, ValueError):
+                    pass
+                self._log_lines = 0
+                self._map()
+            return
+        if stat.st_ino != self._log_inode or stat.st_size < self._log_position:
+            self._reset()
+            self._log_inode = stat.st_ino
+        if stat.st_size > self._log_position:
+            with open(self.log_path, "rb") as f:
+                f.seek(self._log_position)
+                appended = f.read(stat.st_size - self._log_position)
+            # A line that is still being written is read on the next look
+            complete = appended[:appended.rfind(b"\n") + 1]
+            self._log_position += len(complete)
+            self._apply(complete.decode().splitlines())
+        self._map()
+
+    def _map(self):
+        size = os.path.getsize(self.data_path) if os.path.isfile(self.data_path) else 0
+        if size == self._data_size:
+            return
+        self._data_size = size
+        rows = size // self.row_size
+        self._matrix = np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(rows, self.length)) if rows else None
+
+    def _append_log(self, lines: list):
+        if not os.path.isfile(self.log_path) and self._index:
+            # The first write after the JSON index starts the log from it
+            lines = [f"{i}\t{r}" for i, r in self._index.items()] + lines
+        with open(self.log_path, "a") as f:
+            f.write("".join(line + "\n" for line in lines))
+        if self._log_lines > 2 * (len(self._index) + len(self._free)) + 1024:
+            self._compact()
+        if os.path.isfile(self.index_path):
+            os.remove(self.index_path)
+
+    def _compact(self):
+        self._load()
+        tmp_path = f"{self.log_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(f"{i}\t{r}\n" for i, r in self._index.items()))
+            f.write("".join(f"\t{r}\n" for r in self._free))
+        os.replace(tmp_path, self.log_path)
+
+    def __contains__(self, video_id: str) -> bool:
+        self._load()
+        return video_id in self._index
+
+    def put(self, video_id: str, vector) -> bool:
+        """
+            Stores the row of a video, replacing the one it has.
+        """
+        return self.put_many([(video_id, vector)]) == 1
+
+    def put_many(self, items) -> int:
+        """
+            Stores the (video_id, vector) rows under one lock and one log append, skipping
+            missing vectors. Returns how many were stored.
+        """
+        items = [(i, np.asarray(v, dtype=self.dtype)) for i, v in items if v is not None and len(v) == self.length]
+        if not items:
+            return 0
+
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            lines = []
+            mode = "r+b" if os.path.isfile(self.data_path) else "w+b"
+            with open(self.data_path, mode) as f:
+                # Rounded down, a partly written row from a crash is overwritten
+                end = f.seek(0, os.SEEK_END) // self.row_size
+                for video_id, vector in items:
+                    row = self._index.get(video_id)
+                    if row is None:
+                        row = self._free.pop() if self._free else end
+                        end = max(end, row + 1)
+                    f.seek(row * self.row_size)
+                    f.write(vector.tobytes())
+                    self._index[video_id] = row
+                    lines.append(f"{video_id}\t{row}")
+            self._append_log(lines)
+        return len(items)
+
+    def remove(self, video_id: str) -> bool:
+        """
+            Forgets the row of a video, it is reused by the next video that is added.
+        """
+        if not os.path.isdir(self.folder):
+            return False
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            if video_id not in self._index:
+                return False
+            self._free.add(self._index.pop(video_id))
+            self._append_log([f"{video_id}\t"])
+        return True
+
+    def get(self, video_id: str):
+        self._load()
+        row = self._index.get(video_id)
+        if row is None or self._matrix is None or row >= len(self._matrix):
+            return None
+        return np.array(self._matrix[row])
+
+    def rows(self, video_ids: list) -> (list, np.ndarray):
+        """
+            The stored ids among video_ids and their rows as one matrix.
+        """
+        self._load()
+        if self._matrix is None:
+            return [], np.empty((0, self.length), dtype=self.dtype)
+        found = [(i, self._index[i]) for i in video_ids if self._index.get(i, len(self._matrix)) < len(self._matrix)]
+        return [i for i, _r in found], self._matrix[[r for _i, r in found]]
+
+
+class ThumbnailStore(FeatureStore):
+    def __init__(self, folder: str, name: str):
+        super().__init__(folder, name, FEATURE_LENGTH, np.uint8)
+
+    def add_thumbnail(self, video_id: str) -> bool:
+        return self.put(video_id, image_vector(os.path.join(thumbnail_path, video_id + "_thumb.jpg")))
+
+    def add_thumbnails(self, video_ids: list) -> int:
+        return self.put_many(
+            (i, image_vector(os.path.join(thumbnail_path, i + "_thumb.jpg"))) for i in video_ids
+        )
+
+    def compare(self, video_id: str, other_ids: list) -> dict:
+        """
+            Mean absolute difference in percent between a video's vector and each of the
+            others that are stored, by video id.
+        """
+        vector = self.get(video_id)
+        ids, vectors = self.rows(other_ids)
+        if vector is None or not ids:
+            return {}
+        diff = np.abs(vectors.astype(np.int16) - vector.astype(np.int16)).mean(axis=1) * (100.0 / 255.0)
+        return {i: float(d) for i, d in zip(ids, diff)}
+
+
+class FingerprintStore(FeatureStore):
+    def __init__(self, folder: str, name: str):
+        super().__init__(folder, name, FINGERPRINT_FRAMES, np.uint64)
+
+    def score(self, video_id: str, other_ids: list) -> dict:
+        """
+            Alignment score of a video's frame hashes against each of the others, by video id.
+        """
+        fingerprint = self.get(video_id)
+        ids, fingerprints = self.rows(other_ids)
+        if fingerprint is None or not ids:
+            return {}
+        return dict(zip(ids, fingerprint_scores(fingerprint, fingerprints).tolist()))
+
+
+class AudioIndex(object):
+    """
+        Inverted index of audio peak hashes. The (hash, video, offset) records of a video are
+        appended as one range of a flat file, found through an append-only log of
+        "<video_id>\t<number>\t<start>\t<count>" lines ("<video_id>\t" once removed), so a
+        video's own hashes are read straight from its range. They are looked up with binary
+        searches in a hash-sorted copy of the records up to the last merge, and in the newer
+        tail sorted in memory. merge() folds the tail into the sorted copy and drops the
+        records of removed or re-added videos, writing a new generation of the files.
+    """
+    def __init__(self, folder: str, name: str):
+        self.folder = folder
+        self.name = name
+        self.current_path = os.path.join(folder, name + ".current")
+        self.lock_path = os.path.join(folder, name + ".lock")
+        # The single file and JSON index of earlier versions, converted by the first writer
+        self.legacy_data_path = os.path.join(folder, name + ".hashes")
+        self.legacy_index_path = os.path.join(folder, name + ".json")
+        self._reset(None)
+
+    def _path(self, generation: int, ext: str) -> str:
+        return os.path.join(self.folder, f"{self.name}.{generation}.{ext}")
+
+    def _reset(self, generation):
+        self._generation = generation
+        self._index = {}
+        self._videos = {}
+        self._next = 0
+        self._end = 0
+        self._dead = 0
+        self._log_position = 0
+        self._data = np.empty(0, dtype=AUDIO_RECORD)
+        self._sorted = np.empty(0, dtype=AUDIO_RECORD)
+        self._sorted_keys = np.empty(0, dtype="<u4")
+        self._tail = None
+        self._tail_keys = None
+
+    def _read_generation(self):
+        try:
+            with open(self.current_path) as f:
+                return int(json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _apply(self, lines: list):
+        for line in lines:
+            video_id, _tab, entry = line.partition("\t")
+            previous = self._index.pop(video_id, None)
+            if previous is not None:
+                self._videos.pop(previous[0], None)
+                self._dead += previous[2]
+            if entry:
+                number, start, count = (int(x) for x in entry.split("\t"))
+                self._index[video_id] = (number, start, count)
+                self._videos[number] = (video_id, count)
+                self._next = max(self._next, number + 1)
+                self._end = max(self._end, start + count)
+
+    def _load(self):
+        # Files of a generation are removed once the next one is in place, look again once
+        for _attempt in range(2):
+            try:
+                self._refresh()
+                return
+            except OSError:
+                self._reset(None)
+
+    def _refresh(self):
+        generation = self._read_generation()
+        if generation != self._generation:
+            self._reset(generation)
+            if generation is not None:
+                rows = os.path.getsize(self._path(generation, "sorted")) // AUDIO_RECORD.itemsize
+                if rows:
+                    self._sorted = np.memmap(self._path(generation, "sorted"), dtype=AUDIO_RECORD, mode="r", shape=(rows,))
+                    self._sorted_keys = np.memmap(self._path(generation, "keys"), dtype="<u4", mode="r", shape=(rows,))
+        if generation is None:
+            return
+
+        size = os.path.getsize(self._path(generation, "log"))
+        if size > self._log_position:
+            with open(self._path(generation, "log"), "rb") as f:
+                f.seek(self._log_position)
+                appended = f.read(size - self._log_position)
+            # A line that is still being written is read on the next look
+            complete = appended[:appended.rfind(b"\n") + 1]
+            self._log_position += len(complete)
+            self._apply(complete.decode().splitlines())
+
+        rows = os.path.getsize(self._path(generation, "hashes")) // AUDIO_RECORD.itemsize
+        if rows != len(self._data):
+            self._data = np.memmap(self._path(generation, "hashes"), dtype=AUDIO_RECORD, mode="r", shape=(rows,)) \
+                if rows else np.empty(0, dtype=AUDIO_RECORD)
+            self._tail, self._tail_keys = None, None
+
+    def _sorted_tail(self) -> (np.ndarray, np.ndarray):
+        """
+            The records added since the last merge and their hashes, sorted by hash on first use.
+        """
+        if self._tail is None:
+            tail = np.array(self._data[len(self._sorted):])
+            self._tail = tail[np.argsort(tail["hash"], kind="stable")]
+            self._tail_keys = np.ascontiguousarray(self._tail["hash"])
+        return self._tail, self._tail_keys
+
+    def _write_generation(self, entries: list, data, by_hash):
+        """
+            Writes the (video_id, number, start, count) ranges of data, in that order, and
+            by_hash, the same records sorted by hash, as the next generation and switches to it.
+        """
+        generation = (self._generation or 0) + 1
+        lines, position = [], 0
+        with open(self._path(generation, "hashes"), "wb") as f:
+            for video_id, number, start, count in entries:
+                f.write(np.asarray(data[start:start + count]).tobytes())
+                lines.append(f"{video_id}\t{number}\t{position}\t{count}\n")
+                position += count
+        with open(self._path(generation, "sorted"), "wb") as f:
+            f.write(by_hash.tobytes())
+        with open(self._path(generation, "keys"), "wb") as f:
+            f.write(np.ascontiguousarray(by_hash["hash"]).tobytes())
+        with open(self._path(generation, "log"), "w") as f:
+            f.write("".join(lines))
+        _replace_json(self.current_path, generation)
+
+        if self._generation is not None:
+            for ext in ("hashes", "sorted", "keys", "log"):
+                try:
+                    os.remove(self._path(self._generation, ext))
+                except OSError:
+                    pass
+        self._load()
+
+    def _convert_legacy(self):
+        if self._read_generation() is not None or not os.path.isfile(self.legacy_index_path):
+            return
+        try:
+            with open(self.legacy_index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        rows = os.path.getsize(self.legacy_data_path) // AUDIO_RECORD.itemsize \
+            if os.path.isfile(self.legacy_data_path) else 0
+        data = np.memmap(self.legacy_data_path, dtype=AUDIO_RECORD, mode="r", shape=(rows,)) if rows else \
+            np.empty(0, dtype=AUDIO_RECORD)
+
+        # Each video's records were appended in one write, so they are one run of its number
+        videos = np.asarray(data["video"])
+        starts = np.flatnonzero(np.r_[True, videos[1:] != videos[:-1]]) if rows else np.empty(0, dtype=np.int64)
+        ranges = {
+            int(videos[start]): (int(start), int(end - start))
+            for start, end in zip(starts, np.r_[starts[1:], rows])
+        }
+        entries = sorted(
+            ((video_id, number) + ranges[number] for video_id, (number, _count) in index.items() if number in ranges),
+            key=lambda e: e[2]
+        )
+        live = np.concatenate([data[start:start + count] for _i, _n, start, count in entries]) if entries else \
+            np.empty(0, dtype=AUDIO_RECORD)
+        self._write_generation(entries, data, live[np.argsort(live["hash"], kind="stable")])
+        for path in (self.legacy_data_path, self.legacy_index_path):
+            os.remove(path)
+
+    def _prepare(self):
+        """
+            The current generation, ready for writing. Call while holding the lock.
+        """
+        self._convert_legacy()
+        self._load()
+        if self._generation is None:
+            self._write_generation([], np.empty(0, dtype=AUDIO_RECORD), np.empty(0, dtype=AUDIO_RECORD))
+
+    def __contains__(self, video_id: str) -> bool:
+        self._load()
+        return video_id in self._index
+
+    def add(self, video_id: str, fingerprint) -> bool:
+        """
+            Indexes the (hashes, offsets) of a video, replacing the ones it has.
+        """
+        if fingerprint is None:
+            return False
+        hashes, offsets = fingerprint
+        records = np.empty(len(hashes), dtype=AUDIO_RECORD)
+        records["hash"], records["offset"] = hashes, offsets
+
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._prepare()
+            records["video"] = self._next
+            with open(self._path(self._generation, "hashes"), "r+b") as f:
+                # Records written before a crash but never logged are overwritten
+                f.truncate(self._end * AUDIO_RECORD.itemsize)
+                f.seek(self._end * AUDIO_RECORD.itemsize)
+                f.write(records.tobytes())
+            with open(self._path(self._generation, "log"), "a") as f:
+                f.write(f"{video_id}\t{self._next}\t{self._end}\t{len(records)}\n")
+            self._load()
+        return True
+
+    def remove(self, video_id: str) -> bool:
+        """
+            Forgets the hashes of a video, its records are dropped by the next merge.
+        """
+        if not os.path.isdir(self.folder):
+            return False
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._prepare()
+            if video_id not in self._index:
+                return False
+            with open(self._path(self._generation, "log"), "a") as f:
+                f.write(f"{video_id}\t\n")
+            self._load()
+        return True
+
+    def needs_merge(self) -> bool:
+        """
+            Whether the unsorted tail or the records of removed videos have grown enough
+            for merge() to be worth it.
+        """
+        self._load()
+        if os.path.isfile(self.legacy_index_path):
+            return True
+        return len(self._data) - len(self._sorted) > AUDIO_MERGE_RECORDS or \
+            self._dead > max(AUDIO_MERGE_RECORDS, len(self._data) // 2)
+
+    def merge(self) -> bool:
+        """
+            Merges the tail into the sorted records and drops dead ones, as a new generation.
+            Readers keep using the previous one until they look again.
+        """
+        if not os.path.isdir(self.folder):
+            return False
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.needs_merge():
+                return False
+            self._prepare()
+            live = np.fromiter(self._videos, dtype=np.int64)
+            sorted_records = self._sorted[np.isin(self._sorted["video"], live)]
+            tail, _keys = self._sorted_tail()
+            tail = tail[np.isin(tail["video"], live)]
+
+            # Both are sorted by hash, so the tail only needs inserting
+            positions = np.searchsorted(sorted_records["hash"], tail["hash"], "right") + np.arange(len(tail))
+            by_hash = np.empty(len(sorted_records) + len(tail), dtype=AUDIO_RECORD)
+            rest = np.ones(len(by_hash), dtype=bool)
+            rest[positions] = False
+            by_hash[positions] = tail
+            by_hash[rest] = sorted_records
+
+            entries = sorted(((i, n, s, c) for i, (n, s, c) in self._index.items()), key=lambda e: e[2])
+            self._write_generation(entries, self._data, by_hash)
+        return True
+
+    def find(self, video_id: str) -> dict:
+        """
+            Other videos sharing at least AUDIO_MIN_MATCHES hashes of the video at one time
+            offset, by video id, with the share of the shorter fingerprint that lines up.
+        """
+        self._load()
+        if video_id not in self._index:
+            return {}
+        number, start, count = self._index[video_id]
+        own = np.array(self._data[start:start + count])
+
+        # Every record with the same hash as one of the video's, next to the offset of that hash
+        found, own_offsets = [], []
+        for records, keys in ((self._sorted, self._sorted_keys), self._sorted_tail()):
+            first = np.searchsorted(keys, own["hash"], "left")
+            lengths = np.searchsorted(keys, own["hash"], "right") - first
+            total = int(lengths.sum())
+            if total:
+                found.append(records[np.repeat(first - np.cumsum(lengths) + lengths, lengths) + np.arange(total)])
+                own_offsets.append(np.repeat(own["offset"], lengths))
+        if not found:
+            return {}
+        found = np.concatenate(found)
+
+        # Halved, an offset one frame off still lands in the same bin
+        deltas = (found["offset"].astype(np.int64) - np.concatenate(own_offsets).astype(np.int64)) // 2
+        keys = (found["video"].astype(np.int64) << 32) | (deltas + (1 << 16))
+        keys, votes = np.unique(keys[found["video"] != number], return_counts=True)
+        if not len(keys):
+            return {}
+
+        videos = keys >> 32
+        first = np.flatnonzero(np.r_[True, videos[1:] != videos[:-1]])
+        matches = {}
+        for other, best in zip(videos[first].tolist(), np.maximum.reduceat(votes, first).tolist()):
+            other_id, other_count = self._videos.get(other, (None, 0))
+            if other_id is not None and best >= AUDIO_MIN_MATCHES:
+                matches[other_id] = best / min(count, other_count)
+        return matches
+
+
+thumbnail_features = ThumbnailStore(feature_path, "thumbnails")
+video_fingerprints = FingerprintStore(feature_path, "fingerprints")
+audio_fingerprints = AudioIndex(feature_path, "audio")
@@ -6,6 +6,7 @@ import shortuuid
 from html import unescape
 from datetime import datetime
 from urllib.parse import urlencode, urlparse, urlunparse, parse_qs
+from werkzeug.http import parse_accept_header
 
 TIME_QUERIES = [
     "s", "t", "time", "seek", "context", "feature"
@@ -37,6 +38,32 @@ DISPOSABLE_QUERIES = [
 TIME_LOCATIONS = [
     "twitter.com", "youtube.com", "t.co", "youtu.be", "nrk.no", "reddit.com", "redd.it"
 ]
+IMAGE_VARIANT_TYPES = {".webp": "image/webp", ".avif": "image/avif"}
+
+
+def pick_image_variant(path: str, accept: str) -> str:
+    """
+        Smallest existing file among a JPEG and its WebP/AVIF variants that the Accept header
+        allows. Only explicitly listed types count, many clients send */* for images as well.
+    """
+    accepted = {value.lower() for value, quality in parse_accept_header(accept or "") if quality > 0}
+    base = os.path.splitext(path)[0]
+    best, best_size = path, None
+    for ext, mimetype in IMAGE_VARIANT_TYPES.items():
+        if mimetype not in accepted:
+            continue
+        try:
+            size = os.path.getsize(base + ext)
+        except OSError:
+            continue
+        if best_size is None:
+            try:
+                best_size = os.path.getsize(path)
+            except OSError:
+                best_size = size + 1
+        if size < best_size:
+            best, best_size = base + ext, size
+    return best
 
 
 def unique_filename() -> str:
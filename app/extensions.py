@@ -1,3 +1,12 @@
+from os import environ
+
+import redis
+from dotenv import load_dotenv
 from flask_caching import Cache
 
+load_dotenv()
+
 cache = Cache()
+redis_client = redis.StrictRedis.from_url(
+    environ.get("BROKER_URL") or "redis://localhost:6379", charset="utf-8", decode_responses=True
+)
@@ -1,12 +1,12 @@
 import pytz
 from feedgen.feed import FeedGenerator
-from flask import make_response, Blueprint, current_app, request
-from sqlalchemy import or_, not_
+from flask import make_response, Blueprint, current_app, request, url_for
+from sqlalchemy import not_
 from werkzeug.local import LocalProxy
 
 from app.dl import STATUS_COMPLETED
 from app.extensions import cache
-from app.serve.db import Video, db_session, ContentTag, Category
+from app.serve.db import Video, db_session, paginate_videos_by_cursor, get_reference_data
 
 feeds = Blueprint(
     'feeds', __name__,
@@ -16,6 +16,8 @@ feeds = Blueprint(
 )
 logger = LocalProxy(lambda: current_app.logger)
 
+RSS_PAGE_SIZE = 30
+
 
 @feeds.route('/rss')
 def rss():
@@ -47,26 +49,27 @@ def rss():
     fg.description('Videos archived for posterity')
     fg.link(href='https://posterity.no')
 
+    ref = get_reference_data()
     vq = db_session.query(Video).filter_by(verified=True).filter_by(private=False).filter_by(status=STATUS_COMPLETED)
 
     if len(content_tag):
-        t = db_session.query(ContentTag).filter(or_(ContentTag.name==content_tag, ContentTag.stub==content_tag)).first()
+        t = ref.tags.find(content_tag)
         if t:
             vq = vq.filter(Video.tags.any(id=t.id))
     if len(category_tag):
-        t = db_session.query(Category).filter(or_(Category.name==category_tag, Category.stub==category_tag)).first()
+        t = ref.categories.find(category_tag)
         if t:
             vq = vq.filter(Video.categories.any(id=t.id))
     if len(ignore_content_tag):
-        t = db_session.query(ContentTag).filter(or_(ContentTag.name==ignore_content_tag, ContentTag.stub==ignore_content_tag)).first()
+        t = ref.tags.find(ignore_content_tag)
         if t:
             vq = vq.filter(not_(Video.tags.any(id=t.id)))
     if len(ignore_category_tag):
-        t = db_session.query(Category).filter(or_(Category.name==ignore_category_tag, Category.stub==ignore_category_tag)).first()
+        t = ref.categories.find(ignore_category_tag)
         if t:
             vq = vq.filter(not_(Video.categories.any(id=t.id)))
 
-    videos = vq.order_by(Video.upload_time.desc()).limit(30).all()
+    videos, next_cursor = paginate_videos_by_cursor(vq, request.args.get("after", ""), RSS_PAGE_SIZE)
 
     for video in reversed(videos):
         fe = fg.add_entry()
@@ -78,5 +81,9 @@ def rss():
 
     response = make_response(fg.rss_str())
     response.headers.set('Content-Type', 'application/rss+xml')
+    if len(next_cursor):
+        args = request.args.to_dict()
+        args["after"] = next_cursor
+        response.headers.set('Link', f'<{url_for("feeds.rss", _external=True, **args)}>; rel="next"')
 
     return response
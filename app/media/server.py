@@ -0,0 +1,265 @@
+"""
+    ASGI app serving video files and images for /view, /download, /thumbnail, /preview, /img, /sprites and /hls,
+    so slow clients don't hold a uWSGI worker for the length of a transfer. It shares the
+    media paths and the Video visibility rules with the Flask app and reads the same session
+    and remember cookies. Run with e.g. `uvicorn media_asgi:app --workers 2`.
+"""
+import asyncio
+import mimetypes
+import os
+import re
+from email.utils import formatdate
+from http.cookies import SimpleCookie, CookieError
+from urllib.parse import parse_qs
+
+from flask import Flask
+from flask_login.utils import decode_cookie
+from itsdangerous import BadSignature
+
+from app import get_environment
+from app.config import config as app_config
+from app.extensions import cache
+from app.dl import hls_path, image_path, sprite_path, IMAGE_CACHE_MAX_AGE, HLS_PLAYLIST, HLS_PLAYLIST_MAX_AGE, \
+    HLS_SEGMENT_MAX_AGE
+from app.dl.helpers import pick_image_variant
+
+CHUNK_SIZE = 256 * 1024
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+ROUTES = [
+    (re.compile(r"^/view/([\w-]+)\.mp4$"), "view"),
+    (re.compile(r"^/download/([\w-]+)$"), "download"),
+    (re.compile(r"^/thumbnail/([\w-]+)\.jpg$"), "thumbnail"),
+    (re.compile(r"^/preview/([\w-]+)\.jpg$"), "preview"),
+    (re.compile(r"^/hls/([\w-]+)/(index\.m3u8|init(?:_[0-9a-f]+)?\.mp4|seg_(?:[0-9a-f]+_)?\d+\.m4s)$"), "hls"),
+    (re.compile(r"^/img/([\w-]+)_((?:thumb|preview)_[0-9a-f]+\.jpg)$"), "img"),
+    (re.compile(r"^/sprites/([0-9a-f]{40})(\.jpg)$"), "sprite"),
+]
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), "serve", "static")
+FALLBACK_IMAGES = {
+    "thumbnail": os.path.join(STATIC_FOLDER, "no_thumbnail.jpg"),
+    "preview": os.path.join(STATIC_FOLDER, "no_preview.jpg"),
+}
+
+# Only used for config, session cookies and an app context for the models
+flask_app = Flask(app_config[get_environment()].APP_NAME)
+flask_app.config.from_object(app_config[get_environment()])
+flask_app.config["SECRET_KEY"] = app_config[get_environment()].SECRET_KEY
+cache.init_app(flask_app)
+flask_app.app_context().push()
+
+from app.serve.db import db_session, Video, User
+
+
+class AnonymousMediaUser(object):
+    auth_level = -1
+    username = "Anonymous"
+    is_editor = False
+
+    def check_auth(self, _level: int) -> bool:
+        return False
+
+
+def user_id_from_cookies(cookie_header: str):
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header)
+    except CookieError:
+        return None
+
+    name = flask_app.config["SESSION_COOKIE_NAME"]
+    if name in cookies:
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        try:
+            data = serializer.loads(
+                cookies[name].value, max_age=int(flask_app.permanent_session_lifetime.total_seconds())
+            )
+        except BadSignature:
+            data = {}
+        if "_user_id" in data:
+            return data["_user_id"]
+
+    remember = flask_app.config.get("REMEMBER_COOKIE_NAME", "remember_token")
+    if remember in cookies:
+        return decode_cookie(cookies[remember].value)
+    return None
+
+
+def find_media_file(kind: str, video_id: str, user_id, original: bool, file_name: str = "", height: int = 0) -> tuple:
+    """
+        Runs in a worker thread: loads the video and user, applies the visibility rules and
+        picks the file the same way the Flask routes do. Returns the path, empty if there is
+        nothing to send, and whether the video is public so shared caches may keep it.
+    """
+    try:
+        video = db_session.query(Video).filter_by(video_id=video_id).first()
+        if not video:
+            return "", False
+        user = None
+        if user_id:
+            try:
+                user = User.query.get(int(user_id))
+            except (TypeError, ValueError):
+                user = None
+        if not video.user_can_see(user or AnonymousMediaUser()):
+            return "", False
+        if kind in ("view", "download"):
+            return video.video_file(original=original, height=height), video.is_public
+        elif kind == "hls":
+            p = os.path.join(hls_path, video.video_id, file_name)
+            return p if video.hls_playlist and os.path.isfile(p) else "", video.is_public
+        elif kind == "thumbnail":
+            return video.image_file(flask_app.config["THUMBNAIL_FOLDER"], "thumb"), video.is_public
+        return video.image_file(flask_app.config["PREVIEW_FOLDER"], "preview"), video.is_public
+    finally:
+        db_session.remove()
+
+
+def parse_range(header: str, size: int):
+    """
+        Parses a single byte range. Returns (start, stop), None to ignore the header and
+        send everything, or False if the range can't be satisfied.
+    """
+    m = RANGE_PATTERN.match(header.strip())
+    if not m or not any(m.groups()):
+        return None
+    first, last = m.groups()
+    if not first:
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    stop = min(int(last) + 1, size) if last else size
+    return start, stop
+
+
+async def send_simple(send, status: int, body: bytes = b"", headers: list = None):
+    headers = (headers or []) + [(b"content-length", str(len(body)).encode())]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_file(scope, send, path: str, request_headers: dict, attachment: bool = False, extra_headers: list = None):
+    st = await asyncio.to_thread(os.stat, path)
+    size = st.st_size
+    etag = f'"{int(st.st_mtime)}-{size}"'
+    last_modified = formatdate(st.st_mtime, usegmt=True)
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = [
+        (b"content-type", mimetype.encode()),
+        (b"etag", etag.encode()),
+        (b"last-modified", last_modified.encode()),
+        (b"accept-ranges", b"bytes"),
+    ]
+    headers += extra_headers or []
+    if attachment:
+        headers.append((b"content-disposition", f"attachment; filename={os.path.basename(path)}".encode()))
+
+    if request_headers.get("if-none-match") == etag:
+        return await send_simple(send, 304, headers=headers)
+
+    status, start, stop = 200, 0, size
+    range_header = request_headers.get("range")
+    if_range = request_headers.get("if-range")
+    if range_header and (not if_range or if_range in (etag, last_modified)):
+        byte_range = parse_range(range_header, size)
+        if byte_range is False:
+            return await send_simple(send, 416, headers=[(b"content-range", f"bytes */{size}".encode())])
+        elif byte_range:
+            status, (start, stop) = 206, byte_range
+            headers.append((b"content-range", f"bytes {start}-{stop - 1}/{size}".encode()))
+
+    headers.append((b"content-length", str(stop - start).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    if scope["method"] == "HEAD":
+        return await send({"type": "http.response.body", "body": b""})
+
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    if scope["method"] not in ("GET", "HEAD"):
+        return await send_simple(send, 405, b"Method not allowed.", [(b"allow", b"GET, HEAD")])
+
+    kind, video_id, file_name = None, "", ""
+    for pattern, route in ROUTES:
+        m = pattern.match(scope["path"])
+        if m:
+            kind, video_id = route, m.group(1)
+            file_name = m.group(2) if m.lastindex > 1 else ""
+            break
+    if not kind:
+        return await send_simple(send, 404, b"Not found.")
+
+    request_headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+    if kind in ("img", "sprite"):
+        # Content-versioned, no visibility lookup needed
+        if kind == "img":
+            path = os.path.join(image_path, f"{video_id}_{file_name}")
+        else:
+            path = os.path.join(sprite_path, video_id + file_name)
+        if not await asyncio.to_thread(os.path.isfile, path):
+            return await send_simple(send, 404, b"Not found.")
+        path = await asyncio.to_thread(pick_image_variant, path, request_headers.get("accept", ""))
+        cache_control = f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable".encode()
+        return await send_file(scope, send, path, request_headers,
+                               extra_headers=[(b"cache-control", cache_control), (b"vary", b"Accept")])
+
+    args = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    try:
+        default = "1" if kind == "download" else "0"
+        original = int(args.get("orig", [default])[0]) != 0
+    except ValueError:
+        original = kind == "download"
+    try:
+        height = int(args.get("h", ["0"])[0])
+    except ValueError:
+        height = 0
+
+    user_id = user_id_from_cookies(request_headers.get("cookie", ""))
+    path, public = await asyncio.to_thread(find_media_file, kind, video_id, user_id, original, file_name, height)
+    if not path and kind in FALLBACK_IMAGES:
+        path = FALLBACK_IMAGES[kind]
+    if not path:
+        return await send_simple(send, 404, b"Video file not found.")
+    if kind in FALLBACK_IMAGES:
+        path = await asyncio.to_thread(pick_image_variant, path, request_headers.get("accept", ""))
+        return await send_file(scope, send, path, request_headers, extra_headers=[(b"vary", b"Accept")])
+    if kind == "hls":
+        max_age = HLS_PLAYLIST_MAX_AGE if file_name == HLS_PLAYLIST else HLS_SEGMENT_MAX_AGE
+        cache_control = f"{'public' if public else 'private'}, max-age={max_age}"
+        return await send_file(scope, send, path, request_headers,
+                               extra_headers=[(b"cache-control", cache_control.encode())])
+    await send_file(scope, send, path, request_headers, attachment=kind == "download")
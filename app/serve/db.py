@@ -1,10 +1,14 @@
 import os
 import json
+import base64
+import binascii
 from datetime import datetime, timedelta
 import time
 import shortuuid
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Float, Boolean, Table
-from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from collections import namedtuple
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Float, Boolean, Table, \
+    Index, and_, or_, true, tuple_, event, func, distinct, inspect
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session, selectinload, Session
 from sqlalchemy.ext.declarative import declarative_base
 from flask_login import UserMixin
 from contextlib import contextmanager
@@ -13,8 +17,12 @@ from flask import current_app
 from app.dl.helpers import seconds_to_verbose_time, seconds_to_hhmmss, convert_file_size, make_stub
 from app.dl import STATUS_DOWNLOADING, STATUS_PROCESSING, STATUS_INVALID, \
     STATUS_FAILED, STATUS_COMPLETED, STATUS_PENDING, STATUS_COOKIES, STATUS_STRINGS, \
-    MAX_BIT_RATE_PER_PIXEL, MIN_BIT_RATE_PER_PIXEL, STATUS_CHECKING
+    MAX_BIT_RATE_PER_PIXEL, MIN_BIT_RATE_PER_PIXEL, STATUS_CHECKING, original_path, processed_path, \
+    HLS_PLAYLIST, storyboard_path, thumbnail_path
 from app.dl.metadata import get_source_site
+from redis.exceptions import RedisError
+from app.extensions import cache, redis_client
+from app.serve.pages import purge_page_cache, video_page_tag, PAGE_TAG_ALL, PAGE_TAG_VIDEOS
 
 
 log = LocalProxy(lambda: current_app.logger)
@@ -37,6 +45,14 @@ MAX_TOKEN_USES = 20
 
 PROCESSING_RECOMMENDATION = 0.33
 
+THEATRE_SUMMARY_KEY = "theatre_summary"
+THEATRE_SUMMARY_TIMEOUT = 3600
+PENDING_COUNT_KEY = "pending_count"
+PENDING_COUNT_MARKER = "__reconciled__"
+PENDING_ANONYMOUS = "Anonymous"
+REF_DATA_VERSION_KEY = "refdata_version"
+REF_DATA_CHECK_INTERVAL = 2.0
+
 REASON_DUPLICATE        = 0
 REASON_MISSING_TAGS     = 1
 REASON_WRONG_TAGS       = 2
@@ -142,6 +158,7 @@ class Video(Base):
     processed_audio_format = Column(String, default="")
     width = Column(Integer, default=0)
     height = Column(Integer, default=0)
+    aspect_ratio = Column(Float, default=0.0)
     bit_rate = Column(Integer, default=0)
     processed_bit_rate = Column(Integer, default=0)
     frame_rate = Column(Float, default=0.0)
@@ -156,6 +173,11 @@ class Video(Base):
     task_id = Column(String, default="")
     pid = Column(Integer, default=-1)
     private = Column(Boolean, default=False)
+    renditions = Column(String, default="")
+    image_version = Column(String, default="")
+    hls_version = Column(String(16), default="")
+    storyboard_version = Column(String(16), default="")
+    image_hash = Column(String(16), default="")
     user_reports = relationship("UserReport", back_populates="video")
     duplicates = relationship(
         "Video", lambda: video_duplicates,
@@ -173,9 +195,47 @@ class Video(Base):
     categories = relationship("Category", secondary=category_association_table)
     theatres = relationship("Theatre", secondary=theatre_association_table)
 
+    __table_args__ = (
+        Index("ix_videos_upload_time_id", "upload_time", "id"),
+        Index("ix_videos_status_duration", "status", "duration"),
+        Index("ix_videos_aspect_ratio", "aspect_ratio"),
+    )
+
     def __init__(self):
         self.upload_time = datetime.now()
 
+    # Loader option bundles, so templates don't lazy load relationships per row
+    @classmethod
+    def list_options(cls) -> tuple:
+        return (
+            selectinload(cls.tags),
+            selectinload(cls.categories),
+            selectinload(cls.theatres),
+            selectinload(cls.duplicates),
+            selectinload(cls.false_positives),
+            selectinload(cls.user_reports),
+        )
+
+    @classmethod
+    def detail_options(cls) -> tuple:
+        # One video, its pending duplicates are only listed, their relationships aren't used
+        return (
+            selectinload(cls.tags),
+            selectinload(cls.categories),
+            selectinload(cls.theatres),
+            selectinload(cls.duplicates),
+            selectinload(cls.false_positives),
+            selectinload(cls.user_reports),
+        )
+
+    @classmethod
+    def dashboard_options(cls) -> tuple:
+        return (
+            selectinload(cls.duplicates),
+            selectinload(cls.false_positives),
+            selectinload(cls.user_reports),
+        )
+
     @property
     def page_url(self) -> str:
         return f"https://posterity.no/{self.video_id}"
@@ -195,6 +255,11 @@ class Video(Base):
             return True
         return False
 
+    @property
+    def is_public(self) -> bool:
+        # Visible to anonymous visitors, so shared caches may keep its media
+        return _is_public(self.status, self.verified, self.private)
+
     def user_can_see(self, user: User) -> bool:
         if self.ready_to_play and not self.private and self.verified:
             return True
@@ -206,6 +271,21 @@ class Video(Base):
             return True
         return False
 
+    @classmethod
+    def visible_to(cls, user: User):
+        # SQL counterpart of user_can_see, to be used as a query filter
+        if user.check_auth(AUTH_LEVEL_EDITOR):
+            return true()
+
+        playable = and_(cls.status == STATUS_COMPLETED, cls.private.isnot(True))
+        if not user.check_auth(AUTH_LEVEL_USER):
+            return and_(playable, cls.verified.is_(True))
+
+        clauses = [playable]
+        if user.username != "Anonymous":
+            clauses.append(cls.source == user.username)
+        return or_(*clauses)
+
     def user_can_claim(self, user: User) -> bool:
         if self.user_can_edit(user):
             return True
@@ -248,6 +328,114 @@ class Video(Base):
     def ready_to_play(self) -> bool:
         return self.status == STATUS_COMPLETED
 
+    @property
+    def blur_images(self) -> bool:
+        return any(t.category > 1 for t in self.tags)
+
+    @property
+    def rendition_ladder(self) -> list:
+        """
+            Extra post-processed sizes as (height, video bit rate in kbps), largest first.
+        """
+        try:
+            return sorted((tuple(r) for r in json.loads(self.renditions or "[]")), reverse=True)
+        except (TypeError, ValueError):
+            return []
+
+    def video_file(self, original: bool = False, height: int = 0) -> str:
+        """
+            Path of the file to stream or download: the rendition of the given height if there
+            is one, else the post-processed file unless the original is asked for, falling back
+            to whichever exists. Empty if there is none.
+        """
+        if height and any(h == height for h, _br in self.rendition_ladder):
+            p = os.path.join(processed_path, f"{self.video_id}_{height}p.mp4")
+            if os.path.isfile(p):
+                return p
+        if self.post_processed and not original:
+            folders = [processed_path, original_path]
+        else:
+            folders = [original_path, processed_path]
+        for folder in folders:
+            p = os.path.join(folder, f"{self.video_id}.mp4")
+            if os.path.isfile(p):
+                return p
+        return ""
+
+    @property
+    def hls_playlist(self) -> str:
+        if self.hls_version:
+            return f"/hls/{self.video_id}/{HLS_PLAYLIST}"
+        return ""
+
+    @property
+    def storyboard_track(self) -> str:
+        if self.storyboard_version:
+            return f"/storyboard/{self.video_id}.vtt?v={self.storyboard_version}"
+        return ""
+
+    def storyboard_file(self, ext: str) -> str:
+        """
+            Path of the storyboard track or sheet to send, the sheet blurred if the tags ask
+            for it. Empty if there is none.
+        """
+        if ext == "jpg" and self.blur_images:
+            p = os.path.join(storyboard_path, f"{self.video_id}_blurred.jpg")
+        else:
+            p = os.path.join(storyboard_path, f"{self.video_id}.{ext}")
+        return p if self.storyboard_version and os.path.isfile(p) else ""
+
+    def publish_images(self, keep_previous: bool = True) -> bool:
+        """
+            Publishes the thumbnail and preview matching the current tags, see
+            publish_video_images. Returns True if the published version changed.
+        """
+        from app.dl.dl import publish_video_images
+        try:
+            version = publish_video_images(self.video_id, self.blur_images, keep_previous)
+        except OSError as e:
+            log.error(e)
+            log.error(f"Unable to publish images for {self.video_id}.")
+            return False
+        if version == (self.image_version or ""):
+            return False
+        self.image_version = version
+        return True
+
+    def update_image_hash(self) -> bool:
+        """
+            Perceptual hash of the clear thumbnail, used to find duplicates. Returns True if set.
+        """
+        from app.dl.duplicates import dhash
+        h = dhash(os.path.join(thumbnail_path, f"{self.video_id}_thumb.jpg"))
+        if h:
+            self.image_hash = h
+        return bool(h)
+
+    @property
+    def thumbnail_url(self) -> str:
+        if self.image_version:
+            return f"/img/{self.video_id}_thumb_{self.image_version}.jpg"
+        return f"/thumbnail/{self.video_id}.jpg"
+
+    @property
+    def preview_url(self) -> str:
+        if self.image_version:
+            return f"/img/{self.video_id}_preview_{self.image_version}.jpg"
+        return f"/preview/{self.video_id}.jpg"
+
+    def image_file(self, folder: str, kind: str) -> str:
+        """
+            Path of the thumbnail ("thumb") or preview image in the folder, blurred if the
+            tags ask for it and a blurred version exists. Empty if there is none.
+        """
+        if self.blur_images:
+            p = os.path.join(folder, f"{self.video_id}_{kind}_blurred.jpg")
+            if os.path.isfile(p):
+                return p
+        p = os.path.join(folder, f"{self.video_id}_{kind}.jpg")
+        return p if os.path.isfile(p) else ""
+
     @property
     def can_be_changed(self) -> bool:
         return self.status not in [STATUS_DOWNLOADING, STATUS_PROCESSING, STATUS_CHECKING]
@@ -398,12 +586,6 @@ class Video(Base):
             return f"{self.width}x{self.height}"
         return "No size"
 
-    @property
-    def aspect_ratio(self) -> float:
-        if self.width and self.height:
-            return self.width / self.height
-        return 0.0
-
     @property
     def preview_width(self) -> int:
         if self.width and self.height:
@@ -468,6 +650,9 @@ class Video(Base):
             "upload_time": time.mktime(self.upload_time.timetuple()) if self.upload_time else 0,
             "orig_upload_time": time.mktime(self.orig_upload_time.timetuple()) if self.orig_upload_time else 0,
             "duplicate": ", ".join(v.video_id for v in self.duplicates),
+            "renditions": self.renditions or "",
+            "image_hash": self.image_hash or "",
+            "storyboard_version": self.storyboard_version or "",
         }
     
     def from_json(self, d: dict):
@@ -516,9 +701,9 @@ class Video(Base):
                 t = [d["theatres"]]
             for stub in t:
                 try:
-                    theatre = Theatre.query.filter_by(stub=stub).first()
+                    theatre = get_reference_data().theatres.by_stub(stub)
                     if theatre:
-                        self.theatres.append(theatre)
+                        self.theatres.append(attach_reference(theatre))
                 except Exception:
                     pass
         except KeyError:
@@ -551,6 +736,20 @@ class Video(Base):
             self.private = d["private"]
         except KeyError:
             pass
+        try:
+            self.renditions = d["renditions"]
+        except KeyError:
+            pass
+        try:
+            if d["image_hash"]:
+                self.image_hash = d["image_hash"]
+        except KeyError:
+            pass
+        try:
+            if d["storyboard_version"]:
+                self.storyboard_version = d["storyboard_version"]
+        except KeyError:
+            pass
         try:
             self.width = d["width"]
         except KeyError:
@@ -559,6 +758,7 @@ class Video(Base):
             self.height = d["height"]
         except KeyError:
             self.height = 0
+        self.aspect_ratio = self.width / self.height if self.width and self.height else 0.0
         try:
             self.bit_rate = d["bit_rate"]
         except KeyError:
@@ -600,19 +800,16 @@ class Video(Base):
         except KeyError:
             log.error("No video id given for json, I hope this gets set manually...")
             pass
+        refs = get_reference_data()
         try:
             tags = d["tags"]
         except KeyError:
             pass
         else:
             for t in tags:
-                try:
-                    ct = ContentTag.query.filter_by(id=int(t)).first()
-                except (TypeError, ValueError):
-                    pass
-                else:
-                    if ct and ct not in self.tags:
-                        self.tags.append(ct)
+                ct = refs.tags.by_id(t)
+                if ct and not has_reference(self.tags, ct):
+                    self.tags.append(attach_reference(ct))
         try:
             if "/" in d["content_warning"]:
                 cw = d["content_warning"].split("/")
@@ -622,19 +819,10 @@ class Video(Base):
             pass
         else:
             for c in cw:
-                tag = ContentTag.query.filter_by(name=c.lstrip().rstrip().capitalize()).first()
-                if not tag:
-                    tag = ContentTag.query.filter_by(name=c.lstrip().rstrip()).first()
-                    if not tag:
-                        try:
-                            int(c)
-                        except (TypeError, ValueError):
-                            pass
-                        else:
-                            tag = ContentTag.query.filter_by(id=int(c)).first()
-
-                if tag and tag not in self.tags:
-                    self.tags.append(tag)
+                c = c.lstrip().rstrip()
+                tag = refs.tags.by_name(c.capitalize()) or refs.tags.by_name(c) or refs.tags.by_id(c)
+                if tag and not has_reference(self.tags, tag):
+                    self.tags.append(attach_reference(tag))
 
         try:
             categories = d["categories"]
@@ -642,13 +830,9 @@ class Video(Base):
             pass
         else:
             for c in categories:
-                try:
-                    ct = Category.query.filter_by(id=int(c)).first()
-                except (TypeError, ValueError):
-                    pass
-                else:
-                    if ct and ct not in self.categories:
-                        self.categories.append(ct)
+                ct = refs.categories.by_id(c)
+                if ct and not has_reference(self.categories, ct):
+                    self.categories.append(attach_reference(ct))
         try:
             if "/" in d["category"]:
                 c = d["category"].split("/")
@@ -658,19 +842,11 @@ class Video(Base):
             pass
         else:
             for ct in c:
-                tag = Category.query.filter_by(name=ct.lstrip().rstrip().capitalize()).first()
-                if not tag:
-                    tag = Category.query.filter_by(name=ct.lstrip().rstrip()).first()
-                    if not tag:
-                        try:
-                            int(ct)
-                        except (TypeError, ValueError):
-                            pass
-                        else:
-                            tag = Category.query.filter_by(id=int(ct)).first()
-
-                if tag and tag not in self.categories:
-                    self.categories.append(tag)
+                ct = ct.lstrip().rstrip()
+                tag = refs.categories.by_name(ct.capitalize()) or refs.categories.by_name(ct) or \
+                    refs.categories.by_id(ct)
+                if tag and not has_reference(self.categories, tag):
+                    self.categories.append(attach_reference(tag))
 
 
 video_duplicates = Table(
@@ -680,6 +856,51 @@ video_duplicates = Table(
 )
 
 
+def encode_video_cursor(video: Video) -> str:
+    position = json.dumps([video.upload_time.isoformat(), video.id])
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_video_cursor(cursor: str):
+    if not cursor:
+        return None
+    try:
+        position = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        upload_time, video_db_id = json.loads(position)
+        return datetime.fromisoformat(upload_time), int(video_db_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        log.error("Invalid pagination cursor given, starting from the top.")
+        return None
+
+
+def paginate_videos_by_cursor(query, cursor: str = "", size: int = 30, backwards=False) -> (list, str):
+    """
+        Keyset pagination over (upload_time, id), newest first. Returns one page
+        of videos and an opaque cursor for the next page ("" on the last page).
+        Backwards, the page is the one before the cursor and the returned cursor
+        points at the page before that ("" on the first page).
+    """
+    # Rows without an upload time have no position, migrations backfill them
+    query = query.filter(Video.upload_time.isnot(None))
+    if backwards:
+        query = query.order_by(Video.upload_time.asc(), Video.id.asc())
+    else:
+        query = query.order_by(Video.upload_time.desc(), Video.id.desc())
+    position = decode_video_cursor(cursor)
+    if position and backwards:
+        query = query.filter(tuple_(Video.upload_time, Video.id) > position)
+    elif position:
+        query = query.filter(tuple_(Video.upload_time, Video.id) < position)
+
+    videos = query.limit(size + 1).all()
+    more = len(videos) > size
+    videos = videos[:size]
+    if backwards:
+        videos.reverse()
+        return videos, encode_video_cursor(videos[0]) if more else ""
+    return videos, encode_video_cursor(videos[-1]) if more else ""
+
+
 class Theatre(Base):
     __tablename__ = "theatres"
     id = Column(Integer, primary_key=True)
@@ -859,13 +1080,417 @@ class DeletedVideo(Base):
         return v
 
 
+TheatreSummary = namedtuple(
+    "TheatreSummary", ["id", "name", "stub", "location", "ongoing", "logo_name", "video_count"]
+)
+
+
+def get_theatre_summary() -> list:
+    """
+        All theatres with their video counts, most videos first. Built with a single
+        GROUP BY and kept in the cache until theatre associations change.
+    """
+    summary = cache.get(THEATRE_SUMMARY_KEY)
+    if summary is not None:
+        return summary
+
+    counts = dict(
+        db_session.query(
+            theatre_association_table.c.theatre_id,
+            func.count(distinct(theatre_association_table.c.video_id))
+        ).group_by(theatre_association_table.c.theatre_id).all()
+    )
+    summary = [
+        TheatreSummary(t.id, t.name, t.stub, t.location, t.ongoing, t.logo_name, counts.get(t.id, 0))
+        for t in db_session.query(Theatre).all()
+    ]
+    summary.sort(key=lambda x: x.video_count, reverse=True)
+    cache.set(THEATRE_SUMMARY_KEY, summary, timeout=THEATRE_SUMMARY_TIMEOUT)
+    return summary
+
+
+def get_theatre_video_counts() -> dict:
+    return {t.id: t.video_count for t in get_theatre_summary()}
+
+
+def invalidate_theatre_summary():
+    try:
+        cache.delete(THEATRE_SUMMARY_KEY)
+    except Exception as e:
+        log.error(e)
+
+
+@event.listens_for(Session, "before_flush")
+def _track_theatre_changes(session, _flush_context, _instances):
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Theatre) or (isinstance(obj, Video) and obj.theatres):
+            session.info["theatres_changed"] = True
+            return
+    for obj in session.dirty:
+        if isinstance(obj, Theatre) or (isinstance(obj, Video) and inspect(obj).attrs.theatres.history.has_changes()):
+            session.info["theatres_changed"] = True
+            return
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_theatre_changes(session):
+    if session.info.pop("theatres_changed", False):
+        invalidate_theatre_summary()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_theatre_changes(session):
+    session.info.pop("theatres_changed", None)
+
+
+ReferenceData = namedtuple("ReferenceData", ["version", "tags", "categories", "theatres"])
+
+
+class ReferenceTable(object):
+    """
+        Detached rows of one reference model with lookups by id, stub and name. Rows have to
+        go through attach_reference() before being added to a relationship.
+    """
+    def __init__(self, rows: list):
+        self.all = rows
+        self._by_id = {r.id: r for r in rows}
+        self._by_stub = {r.stub: r for r in rows}
+        self._by_name = {r.name: r for r in rows}
+
+    def by_id(self, row_id):
+        try:
+            return self._by_id.get(int(row_id))
+        except (TypeError, ValueError):
+            return None
+
+    def by_stub(self, stub: str):
+        return self._by_stub.get(stub)
+
+    def by_name(self, name: str):
+        return self._by_name.get(name)
+
+    def find(self, key: str):
+        return self.by_name(key) or self.by_stub(key)
+
+
+_reference_data = None
+_reference_checked = 0.0
+
+
+def _load_reference_data(version) -> ReferenceData:
+    session = db_session.session_factory()
+    try:
+        tags = session.query(ContentTag).order_by(ContentTag.category.desc(), ContentTag.name).all()
+        categories = session.query(Category).order_by(Category.name).all()
+        theatres = session.query(Theatre).order_by(Theatre.id).all()
+    finally:
+        session.close()
+    return ReferenceData(version, ReferenceTable(tags), ReferenceTable(categories), ReferenceTable(theatres))
+
+
+def get_reference_data() -> ReferenceData:
+    """
+        Process-local copy of all tags, categories and theatres. The version in Redis is
+        checked at most every REF_DATA_CHECK_INTERVAL seconds and a new copy is loaded when
+        another process has bumped it.
+    """
+    global _reference_data, _reference_checked
+    data = _reference_data
+    now = time.time()
+    if data is not None and now - _reference_checked < REF_DATA_CHECK_INTERVAL:
+        return data
+
+    try:
+        version = int(redis_client.get(REF_DATA_VERSION_KEY) or 0)
+    except (RedisError, ValueError) as e:
+        log.error(e)
+        version = None
+    if data is None or version is None or data.version != version:
+        data = _load_reference_data(version)
+        _reference_data = data
+    _reference_checked = now
+    return data
+
+
+def bump_reference_data_version():
+    global _reference_data
+    _reference_data = None
+    try:
+        redis_client.incr(REF_DATA_VERSION_KEY)
+    except RedisError as e:
+        log.error(e)
+
+
+def has_reference(rows, row) -> bool:
+    """
+        Whether a relationship collection holds a row of the reference data cache, by id,
+        as the cached copy isn't the instance the session loaded.
+    """
+    return any(r.id == row.id for r in rows)
+
+
+def attach_reference(row):
+    """
+        Returns the instance of a cached reference row in the current session, without SQL.
+    """
+    if row is None:
+        return None
+    return db_session.merge(row, load=False)
+
+
+@event.listens_for(Session, "before_flush")
+def _track_reference_changes(session, _flush_context, _instances):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, (Theatre, ContentTag, Category)):
+            session.info["reference_changed"] = True
+            return
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_reference_changes(session):
+    if session.info.pop("reference_changed", False):
+        bump_reference_data_version()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_reference_changes(session):
+    session.info.pop("reference_changed", None)
+
+
+def is_pending(status, verified, private) -> bool:
+    """
+        Python mirror of the pending filter: not completed or not verified, and not private.
+    """
+    return ((status is not None and status != STATUS_COMPLETED) or verified is False) and private is False
+
+
+def reconcile_pending_counts() -> dict:
+    """
+        Recounts pending videos per source from the database and replaces the counters in Redis.
+    """
+    # Videos without a source count as anonymous submissions
+    source = func.coalesce(Video.source, PENDING_ANONYMOUS)
+    counts = dict(
+        db_session.query(source, func.count(Video.id)).filter(
+            or_(
+                Video.status != STATUS_COMPLETED,
+                Video.verified != True
+            )
+        ).filter_by(private=False).group_by(source).all()
+    )
+    pipe = redis_client.pipeline()
+    pipe.delete(PENDING_COUNT_KEY)
+    pipe.hset(PENDING_COUNT_KEY, mapping={PENDING_COUNT_MARKER: 0, **counts})
+    pipe.execute()
+    return counts
+
+
+def get_pending_count(user) -> int:
+    """
+        Number of pending videos visible to the user, read from the counters in Redis.
+        Editors see all of them, users only their own and anonymous submissions.
+    """
+    try:
+        counts = redis_client.hgetall(PENDING_COUNT_KEY)
+        if PENDING_COUNT_MARKER not in counts:
+            counts = reconcile_pending_counts()
+    except RedisError as e:
+        log.error(e)
+        q = db_session.query(Video).filter(
+            or_(
+                Video.status != STATUS_COMPLETED,
+                Video.verified != True
+            )
+        )
+        if not user.check_auth(AUTH_LEVEL_EDITOR):
+            q = q.filter(or_(Video.source.in_([PENDING_ANONYMOUS, user.username]), Video.source.is_(None)))
+        return q.filter_by(private=False).count()
+
+    counts.pop(PENDING_COUNT_MARKER, None)
+    if user.check_auth(AUTH_LEVEL_EDITOR):
+        return sum(int(c) for c in counts.values())
+    sources = {PENDING_ANONYMOUS, user.username}
+    return sum(int(counts.get(s, 0)) for s in sources)
+
+
+def _video_state(obj, previous: bool) -> tuple:
+    """
+        Status, verified, private and source of a video, either as they are now or as they
+        were before the pending changes. Raises LookupError if the previous state is not
+        known to the session anymore.
+    """
+    state = inspect(obj)
+    values = []
+    for name in ("status", "verified", "private", "source"):
+        attr = state.attrs[name]
+        hist = attr.history
+        if not previous or not hist.has_changes():
+            value = attr.value
+            default = Video.__table__.c[name].default
+            if value is None and state.pending and default is not None:
+                value = default.arg
+            values.append(value)
+        elif hist.deleted:
+            values.append(hist.deleted[0])
+        else:
+            raise LookupError(name)
+    return tuple(values)
+
+
+def _pending_source(obj, previous: bool):
+    status, verified, private, source = _video_state(obj, previous)
+    if not is_pending(status, verified, private):
+        return None
+    return source if source is not None else PENDING_ANONYMOUS
+
+
+@event.listens_for(Session, "before_flush")
+def _track_pending_changes(session, _flush_context, _instances):
+    deltas = session.info.setdefault("pending_deltas", {})
+    changes = [(obj, False, True) for obj in session.new if isinstance(obj, Video)]
+    changes += [(obj, True, False) for obj in session.deleted if isinstance(obj, Video)]
+    changes += [(obj, True, True) for obj in session.dirty if isinstance(obj, Video) and obj not in session.deleted]
+    for obj, had_previous, has_current in changes:
+        try:
+            before = _pending_source(obj, True) if had_previous else None
+        except LookupError:
+            session.info["pending_reconcile"] = True
+            continue
+        after = _pending_source(obj, False) if has_current else None
+        if before == after:
+            continue
+        if before is not None:
+            deltas[before] = deltas.get(before, 0) - 1
+        if after is not None:
+            deltas[after] = deltas.get(after, 0) + 1
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_pending_changes(session):
+    deltas = session.info.pop("pending_deltas", {})
+    try:
+        if session.info.pop("pending_reconcile", False):
+            # Can't query from here, the next read will recount.
+            redis_client.delete(PENDING_COUNT_KEY)
+        elif any(deltas.values()) and redis_client.hexists(PENDING_COUNT_KEY, PENDING_COUNT_MARKER):
+            pipe = redis_client.pipeline()
+            for source, delta in deltas.items():
+                if delta:
+                    pipe.hincrby(PENDING_COUNT_KEY, source, delta)
+            pipe.execute()
+    except RedisError as e:
+        log.error(e)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_changes(session):
+    session.info.pop("pending_deltas", None)
+    session.info.pop("pending_reconcile", None)
+
+
+@event.listens_for(Session, "before_flush")
+def _unpublish_images_on_blur_change(session, _flush_context, _instances):
+    # The blur decision follows the tags. Until the images are published again after the
+    # commit, pages use the /thumbnail and /preview routes that apply it per request.
+    changed = session.info.setdefault("blur_changed", set())
+    for obj in session.dirty:
+        if not isinstance(obj, Video):
+            continue
+        hist = inspect(obj).attrs.tags.history
+        if not hist.has_changes():
+            continue
+        before = any(t.category > 1 for t in list(hist.unchanged) + list(hist.deleted))
+        if before != obj.blur_images:
+            obj.image_version = ""
+            changed.add(obj.video_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_changed_images(session):
+    changed = session.info.pop("blur_changed", set())
+    if not changed:
+        return
+    from app.core.tasks import publish_images_task
+    try:
+        publish_images_task.apply_async(args=[list(changed), True], priority=0)
+    except Exception as e:
+        log.error(e)
+        log.error("Unable to queue publishing of images.")
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_blur_changes(session):
+    session.info.pop("blur_changed", None)
+
+
+def _is_public(status, verified, private) -> bool:
+    return status == STATUS_COMPLETED and verified is True and private is not True
+
+
+@event.listens_for(Session, "before_flush")
+def _track_page_changes(session, _flush_context, _instances):
+    tags = session.info.setdefault("page_tags", set())
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, (Theatre, ContentTag, Category)):
+            tags.add(PAGE_TAG_ALL)
+        if not isinstance(obj, Video) or (obj in session.dirty and not session.is_modified(obj)):
+            continue
+        tags.add(video_page_tag(obj.video_id))
+        try:
+            before = obj not in session.new and _is_public(*_video_state(obj, True)[:3])
+        except LookupError:
+            before = True
+        after = obj not in session.deleted and _is_public(*_video_state(obj, False)[:3])
+        if before or after:
+            tags.add(PAGE_TAG_VIDEOS)
+        if before and not after:
+            # Pages recommending a video that was hidden would keep showing it
+            tags.update(video_page_tag(i) for i in videos_referencing([obj.video_id]))
+
+
+@event.listens_for(Session, "after_commit")
+def _purge_changed_pages(session):
+    purge_page_cache(*session.info.pop("page_tags", set()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_page_changes(session):
+    session.info.pop("page_tags", None)
+
+
 # To avoid circular imports of Video model
-from .search import index_video_data, remove_videos_index
+from .search import index_video_data, remove_videos_index, create_videos_index, videos_referencing
+
+
+def videos_from_search_hits(hits: list) -> (list, list):
+    """
+        Loads the videos for a list of ElasticSearch hits in a single query, keeping
+        the order of the hits. Returns the videos (with .score set) and the ids of
+        hits that no longer have a row in the database.
+    """
+    ids = [hit["_id"] for hit in hits]
+    if not len(ids):
+        return [], []
+
+    videos = Video.query.options(*Video.list_options()).filter(Video.video_id.in_(ids)).all()
+    by_id = {v.video_id: v for v in videos}
+
+    found = []
+    missing = []
+    for hit in hits:
+        video = by_id.get(hit["_id"])
+        if video:
+            video.score = hit["_score"]
+            found.append(video)
+        else:
+            missing.append(hit["_id"])
+    return found, missing
 
 
 def index_all_videos_from_db():
     try:
         remove_videos_index()
+        create_videos_index()
     except Exception as e:
         log.error(e)
         return
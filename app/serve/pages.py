@@ -0,0 +1,97 @@
+import functools
+import hashlib
+import json
+import time
+from datetime import datetime, timezone
+
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+from werkzeug.local import LocalProxy
+
+from app.extensions import cache
+
+
+PAGE_CACHE_TIMEOUT = 300
+PAGE_CACHE_MAX_AGE = 10
+PAGE_TAG_ALL = "pages"
+PAGE_TAG_VIDEOS = "videos"
+
+log = LocalProxy(lambda: current_app.logger)
+
+
+def video_page_tag(video_id: str) -> str:
+    return f"video:{video_id}"
+
+
+def _tag_key(tag: str) -> str:
+    return f"page_tag:{tag}"
+
+
+def purge_page_cache(*tags):
+    """
+        Drops every cached page carrying any of the tags by moving the tags to a new version.
+    """
+    if not tags:
+        return
+    try:
+        version = str(time.time())
+        cache.set_many({_tag_key(t): version for t in tags}, timeout=0)
+    except Exception as e:
+        log.error(e)
+        log.error("Unable to purge page cache.")
+
+
+def can_cache_page() -> bool:
+    return request.method == "GET" and current_user.is_anonymous and "_flashes" not in session
+
+
+def _page_key(tags: list) -> str:
+    versions = cache.get_many(*[_tag_key(t) for t in tags])
+    args = sorted((k, v) for k, v in request.args.items(multi=True) if v != "")
+    raw = json.dumps([request.path, args, session.get("theatre", ""), versions])
+    return "page:" + hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _page_response(body: bytes, mimetype: str, etag: str, modified: int):
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(modified, timezone.utc)
+    response.cache_control.public = True
+    response.cache_control.max_age = PAGE_CACHE_MAX_AGE
+    response.vary.add("Cookie")
+    return response.make_conditional(request)
+
+
+def cached_page(*tags):
+    """
+        Caches the rendered page for anonymous visitors without pending flash messages.
+        Tags are strings or callables taking the view arguments, see purge_page_cache.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not can_cache_page():
+                return f(*args, **kwargs)
+
+            page_tags = [PAGE_TAG_ALL] + [t(**kwargs) if callable(t) else t for t in tags]
+            try:
+                key = _page_key(page_tags)
+                entry = cache.get(key)
+            except Exception as e:
+                log.error(e)
+                return f(*args, **kwargs)
+
+            if entry is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or "_flashes" in session:
+                    return response
+                body = response.get_data()
+                entry = (body, response.mimetype, hashlib.md5(body).hexdigest(), int(time.time()))
+                try:
+                    cache.set(key, entry, timeout=PAGE_CACHE_TIMEOUT)
+                except Exception as e:
+                    log.error(e)
+            return _page_response(*entry)
+        return wrapper
+    return decorator
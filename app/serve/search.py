@@ -1,16 +1,43 @@
 import functools
+import json
 import os
+import time
 from werkzeug.local import LocalProxy
 from flask import current_app
 from datetime import datetime
 from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch.helpers import bulk
 from elastic_transport import ConnectionError, ConnectionTimeout
-from app.extensions import cache
+from redis.exceptions import RedisError
+from app.extensions import cache, redis_client
 
 
 es = Elasticsearch(os.environ.get("ES_SERVER_ADDRESS", "http://0.0.0.0:9200"))
 log = LocalProxy(lambda: current_app.logger)
 
+MAX_SEARCH_WINDOW = 10000
+# Reads and writes go through this alias, reindexing builds a new index and swaps it
+VIDEO_INDEX_ALIAS = "videos"
+RELATED_VIDEOS_SIZE = 24
+RELATED_VIDEOS_KEY = "related_videos:{}"
+RELATED_BY_KEY = "related_by:{}"
+VIDEO_INDEX_MAPPINGS = {
+    "properties": {
+        "title": {"type": "text"},
+        "orig_title": {"type": "text"},
+        "content_warning": {"type": "text"},
+        "theatre": {"type": "text"},
+        "upload_date": {"type": "double"},
+        "source": {"type": "keyword"},
+        "tags": {"type": "keyword"},
+        "categories": {"type": "keyword"},
+        "theatres": {"type": "keyword"},
+        "status": {"type": "keyword"},
+        "verified": {"type": "boolean"},
+        "private": {"type": "boolean"},
+    }
+}
+
 COMMON = [
     "talking", "about", "subtitles", "with", "without", "longer", "quality", "cnn", "video", "full version",
     "nexta", "rob lee", "how", "reportedly", "possibly", "possible", "footage"
@@ -29,9 +56,59 @@ def catch_es_errors(f) -> []:
     return wrapper
 
 
+def _video_indices() -> list:
+    """
+        The versioned indices behind the alias, or the plain index deployments had before it.
+    """
+    if not es.indices.exists(index=VIDEO_INDEX_ALIAS):
+        return []
+    return list(es.indices.get(index=VIDEO_INDEX_ALIAS).keys())
+
+
 @catch_es_errors
 def remove_videos_index():
-    _result = es.indices.delete(index="videos", ignore=[400, 404])
+    for index in _video_indices():
+        _result = es.indices.delete(index=index, ignore=[400, 404])
+
+
+@catch_es_errors
+def create_videos_index():
+    if es.indices.exists(index=VIDEO_INDEX_ALIAS):
+        return
+    _result = es.indices.create(
+        index=f"{VIDEO_INDEX_ALIAS}_{int(time.time())}", mappings=VIDEO_INDEX_MAPPINGS,
+        aliases={VIDEO_INDEX_ALIAS: {}}, ignore=[400]
+    )
+
+
+@catch_es_errors
+def reindex_videos(videos) -> int:
+    """
+        Indexes the videos into a new index with VIDEO_INDEX_MAPPINGS and moves the alias
+        to it, so mapping changes reach existing deployments. Searches keep using the old
+        index until the swap. Returns the number of indexed videos.
+    """
+    index = f"{VIDEO_INDEX_ALIAS}_{int(time.time())}"
+    es.indices.create(index=index, mappings=VIDEO_INDEX_MAPPINGS)
+    indexed, _errors = bulk(
+        es, ({"_index": index, "_id": v.video_id, "_source": video_document(v)} for v in videos),
+        raise_on_error=False
+    )
+    es.indices.refresh(index=index)
+
+    previous = _video_indices()
+    actions = [{"add": {"index": index, "alias": VIDEO_INDEX_ALIAS}}]
+    for old in previous:
+        # The plain index of older deployments has the alias' name, it goes in the same swap
+        if old == VIDEO_INDEX_ALIAS:
+            actions.append({"remove_index": {"index": old}})
+        else:
+            actions.append({"remove": {"index": old, "alias": VIDEO_INDEX_ALIAS}})
+    es.indices.update_aliases(actions=actions)
+    for old in previous:
+        if old != VIDEO_INDEX_ALIAS:
+            es.indices.delete(index=old, ignore=[404])
+    return indexed
 
 
 @catch_es_errors
@@ -45,31 +122,48 @@ def remove_video_data_by_id(video_id: str):
 
 
 @catch_es_errors
-def index_video_data(video):
-    body = {
+def remove_video_data_by_ids(video_ids: list):
+    if not len(video_ids):
+        return
+    _result = bulk(
+        es, [{"_op_type": "delete", "_index": "videos", "_id": video_id} for video_id in video_ids],
+        raise_on_error=False
+    )
+
+
+def video_document(video) -> dict:
+    return {
         "title": video.title,
         "orig_title": video.orig_title,
         "content_warning": video.content_warning,
         "upload_date": datetime.timestamp(video.orig_upload_time if video.orig_upload_time else video.upload_time),
         "source": video.source,
-        "theatre": video.theatre_verbose
+        "theatre": video.theatre_verbose,
+        "tags": [str(t.id) for t in video.tags],
+        "categories": [str(c.id) for c in video.categories],
+        "theatres": [str(t.id) for t in video.theatres],
+        "status": str(video.status),
+        "verified": bool(video.verified),
+        "private": bool(video.private),
     }
 
-    _result = es.index(index="videos", id=video.video_id, body=body)
+
+@catch_es_errors
+def index_video_data(video):
+    _result = es.index(index="videos", id=video.video_id, body=video_document(video))
 
 
 @catch_es_errors
 def index_all_videos():
     from app.serve.db import session_scope, Video
+    create_videos_index()
     with session_scope() as session:
         videos = session.query(Video).filter_by(private=False).all()
         for v in videos:
             index_video_data(v)
 
 
-@catch_es_errors
-@cache.memoize(60)
-def recommend_videos(video, size=10) -> list:
+def recommend_query(video, size: int = 10) -> dict:
     fields = ["title", "orig_title", "content_warning"]
     text_fields = ["title", "orig_title"]
     theatre_query = video.theatre_verbose
@@ -127,36 +221,154 @@ def recommend_videos(video, size=10) -> list:
                     }
                 ]
             }
-        },
-        "aggregations": {
-            "rare_sample": {
-                "sampler": {
-                    "shard_size": 10,
-                },
-                "aggregations": {
-                    "keywords": {
-                        "significant_text": {
-                            "field": "title"
-                        }
-                    }
-                }
-            }
         }
     }
+    return body
 
-    res = es.search(index="videos", body=body)
+
+@catch_es_errors
+def recommend_videos(video, size=10) -> list:
+    res = es.search(index="videos", body=recommend_query(video, size))
     return res["hits"]["hits"]
 
 
+@catch_es_errors
+def recommend_videos_batch(videos: list, size: int = RELATED_VIDEOS_SIZE) -> dict:
+    """
+        Runs the recommendation query for several videos in one msearch request.
+        Returns {video_id: [(related_id, score), ...]} for the searches that succeeded.
+    """
+    if not len(videos):
+        return {}
+    searches = []
+    for video in videos:
+        searches.append({"index": "videos"})
+        searches.append(recommend_query(video, size + 1))
+    res = es.msearch(searches=searches)
+
+    related = {}
+    for video, response in zip(videos, res["responses"]):
+        if "error" in response:
+            log.error(f"Recommendation search failed for {video.video_id}: {response['error']}")
+            continue
+        hits = [(h["_id"], h["_score"]) for h in response["hits"]["hits"] if h["_id"] != video.video_id]
+        related[video.video_id] = hits[:size]
+    return related
+
+
+def store_related_videos(related: dict):
+    """
+        Saves precomputed related lists, along with the reverse sets used to find which
+        videos are affected when one of them changes.
+    """
+    if not len(related):
+        return
+    previous = redis_client.mget([RELATED_VIDEOS_KEY.format(i) for i in related])
+    pipe = redis_client.pipeline()
+    for (video_id, hits), old in zip(related.items(), previous):
+        for other_id, _score in json.loads(old or "[]"):
+            pipe.srem(RELATED_BY_KEY.format(other_id), video_id)
+        pipe.set(RELATED_VIDEOS_KEY.format(video_id), json.dumps(hits))
+        for other_id, _score in hits:
+            pipe.sadd(RELATED_BY_KEY.format(other_id), video_id)
+    pipe.execute()
+
+
+def get_related_videos(video_id: str):
+    """
+        Precomputed related videos as search hits, or None if they haven't been computed yet.
+    """
+    try:
+        raw = redis_client.get(RELATED_VIDEOS_KEY.format(video_id))
+    except RedisError as e:
+        log.error(e)
+        return None
+    if raw is None:
+        return None
+    try:
+        return [{"_id": i, "_score": score} for i, score in json.loads(raw)]
+    except (TypeError, ValueError) as e:
+        log.error(e)
+        return None
+
+
+def videos_referencing(video_ids: list) -> set:
+    try:
+        pipe = redis_client.pipeline()
+        for video_id in video_ids:
+            pipe.smembers(RELATED_BY_KEY.format(video_id))
+        return set().union(*pipe.execute())
+    except RedisError as e:
+        log.error(e)
+        return set()
+
+
+def forget_related_videos(video_id: str) -> set:
+    """
+        Drops the related list of a removed video. Returns the videos that listed it.
+    """
+    try:
+        referencing = videos_referencing([video_id])
+        store_related_videos({video_id: []})
+        redis_client.delete(RELATED_VIDEOS_KEY.format(video_id), RELATED_BY_KEY.format(video_id))
+    except RedisError as e:
+        log.error(e)
+        return set()
+    return referencing
+
+
+def visibility_filter(auth_level: int, username: str) -> list:
+    # Mirrors Video.visible_to for the search index
+    from app.serve.db import AUTH_LEVEL_USER, AUTH_LEVEL_EDITOR
+    from app.dl import STATUS_COMPLETED
+
+    if auth_level >= AUTH_LEVEL_EDITOR:
+        return []
+
+    playable = [
+        {"term": {"status": str(STATUS_COMPLETED)}},
+        {"term": {"private": False}}
+    ]
+    if auth_level < AUTH_LEVEL_USER:
+        return playable + [{"term": {"verified": True}}]
+
+    should = [{"bool": {"filter": playable}}]
+    if username != "Anonymous":
+        should.append({"term": {"source": username}})
+    return [{"bool": {"should": should, "minimum_should_match": 1}}]
+
+
 @catch_es_errors
 @cache.memoize(10)
-def search_videos(keyword: str, size=100) -> list:
+def search_videos(
+        keyword: str, size=30, offset=0, tag_id=-1, category_id=-1, theatre_id=-1, no_theatre=False,
+        auth_level=-1, username="Anonymous"
+) -> dict:
+    # Pages past the window come back empty with the total, the pager stops before them
+    if offset + size > MAX_SEARCH_WINDOW:
+        offset, size = 0, 0
+
+    filters = visibility_filter(auth_level, username)
+    if tag_id >= 0:
+        filters.append({"term": {"tags": str(tag_id)}})
+    if category_id >= 0:
+        filters.append({"term": {"categories": str(category_id)}})
+    if theatre_id >= 0:
+        filters.append({"term": {"theatres": str(theatre_id)}})
+
+    must_not = []
+    if no_theatre:
+        must_not.append({"exists": {"field": "theatres"}})
 
     fields = ["title", "orig_title", "content_warning"]
     body = {
+        "from": offset,
         "size": size,
+        "track_total_hits": True,
         "query": {
             "bool": {
+                "filter": filters,
+                "must_not": must_not,
                 "must": [
                     {
                         "multi_match": {
@@ -214,4 +426,7 @@ def search_videos(keyword: str, size=100) -> list:
     }
 
     res = es.search(index="videos", body=body)
-    return res["hits"]["hits"]
+    return {
+        "hits": res["hits"]["hits"],
+        "total": res["hits"]["total"]["value"]
+    }
@@ -0,0 +1,97 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from app.dl import image_path, sprite_path
+from app.extensions import cache
+
+
+SPRITE_TILE_SIZE = 64
+SPRITE_MAX_AGE = 7 * 86400
+SPRITE_TOUCH_INTERVAL = 86400
+
+log = LocalProxy(lambda: current_app.logger)
+
+
+SPRITE_BUILD_LOCK_TIMEOUT = 300
+
+
+def _sprite_key(entries: list) -> str:
+    return hashlib.sha1("|".join(f"{video_id}:{version}" for video_id, version in entries).encode("utf-8")).hexdigest()
+
+
+def thumbnail_sprite(videos) -> dict:
+    """
+        One sprite sheet for the published thumbnails of a listing, kept on disk under a key
+        made from the ordered video ids and image versions. Returns the url and the tile
+        (y, width, height) per video id. Until core.tasks.build_sprite has made the sheet,
+        and for videos without published images, the listing uses single images.
+    """
+    entries = list({v.video_id: (v.video_id, v.image_version) for v in videos if v.image_version}.values())
+    if not entries:
+        return None
+    key = _sprite_key(entries)
+    layout_path = os.path.join(sprite_path, key + ".json")
+    try:
+        with open(layout_path) as f:
+            tiles = json.load(f)
+        if not os.path.isfile(os.path.join(sprite_path, key + ".jpg")):
+            raise FileNotFoundError(key)
+        # Keep sheets in use clear of prune_sprites_task
+        if os.path.getmtime(layout_path) < time.time() - SPRITE_TOUCH_INTERVAL:
+            for p in glob.glob(os.path.join(sprite_path, key + ".*")):
+                os.utime(p)
+    except (OSError, ValueError):
+        try:
+            if cache.add(f"sprite_build:{key}", 1, timeout=SPRITE_BUILD_LOCK_TIMEOUT):
+                from app.core.tasks import build_sprite_task
+                build_sprite_task.apply_async(args=[entries], priority=0)
+        except Exception as e:
+            log.error(e)
+            log.error("Unable to queue thumbnail sprite sheet.")
+        return None
+
+    return {"url": f"/sprites/{key}.jpg", "tiles": tiles}
+
+
+def build_sprite(entries: list) -> str:
+    """
+        Builds the sheet for (video id, image version) pairs, the layout is written last so
+        a sheet is only used once it's complete. Returns the key.
+    """
+    from app.dl.dl import build_sprite_sheet
+
+    key = _sprite_key(entries)
+    sheet_path = os.path.join(sprite_path, key + ".jpg")
+    layout_path = os.path.join(sprite_path, key + ".json")
+    if os.path.isfile(layout_path) and os.path.isfile(sheet_path):
+        return key
+
+    os.makedirs(sprite_path, exist_ok=True)
+    sources = [os.path.join(image_path, f"{video_id}_thumb_{version}.jpg") for video_id, version in entries]
+    layout = build_sprite_sheet(sources, sheet_path, SPRITE_TILE_SIZE)
+    tiles = {video_id: tile for (video_id, _version), tile in zip(entries, layout)}
+    tmp_path = f"{layout_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(tiles, f)
+    os.replace(tmp_path, layout_path)
+    return key
+
+
+def prune_sprites(max_age: float = SPRITE_MAX_AGE) -> int:
+    removed = 0
+    cutoff = time.time() - max_age
+    for file_name in os.listdir(sprite_path) if os.path.isdir(sprite_path) else []:
+        p = os.path.join(sprite_path, file_name)
+        try:
+            if os.path.getmtime(p) < cutoff:
+                os.remove(p)
+                removed += 1
+        except OSError:
+            pass
+    return removed
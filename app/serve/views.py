@@ -1,6 +1,7 @@
 import os
-import functools
 import re
+import functools
+import uuid
 import mimetypes
 from dotenv import load_dotenv
 import json
@@ -9,6 +10,9 @@ from flask import Blueprint, current_app, request, abort, \
     render_template, send_from_directory, url_for, flash, \
     redirect, get_flashed_messages, Response, session, make_response
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
+from urllib.parse import quote
+from werkzeug.http import parse_range_header, is_resource_modified
 from flask_login import login_user, login_required, logout_user, current_user
 from redis.exceptions import ConnectionError
 from sqlalchemy.exc import OperationalError, IntegrityError
@@ -24,22 +28,31 @@ serve = Blueprint(
 )
 logger = LocalProxy(lambda: current_app.logger)
 
-from app.dl import media_path, original_path, json_path, processed_path, upload_path, \
+from app.dl import media_path, original_path, json_path, processed_path, upload_path, hls_path, \
+    image_path, sprite_path, storyboard_path, IMAGE_CACHE_MAX_AGE, \
     STATUS_COMPLETED, STATUS_COOKIES, STATUS_DOWNLOADING, STATUS_FAILED, STATUS_INVALID, \
-    STATUS_PROCESSING, STATUS_PENDING, STATUS_CHECKING
-from app.dl.dl import get_celery_scheduled, get_celery_active, generate_logo
+    STATUS_PROCESSING, STATUS_PENDING, STATUS_CHECKING, \
+    HLS_PLAYLIST, HLS_PLAYLIST_MAX_AGE, HLS_SEGMENT_MAX_AGE, STORYBOARD_CACHE_MAX_AGE
+from app.dl.dl import get_celery_scheduled, get_celery_active, generate_logo, remove_derived_media
 from app.dl.metadata import write_metadata_to_disk, get_progress_for_video, load_metadata_from_disk, \
     check_duplicate_for_video
-from app.dl.helpers import seconds_to_verbose_time, map_range, make_stub
+from app.dl.helpers import seconds_to_verbose_time, map_range, make_stub, pick_image_variant
 from app.serve.db import db_session, Video, User, ContentTag, UserReport, Category, Theatre, \
     init_db, AUTH_LEVEL_ADMIN, AUTH_LEVEL_EDITOR, AUTH_LEVEL_USER, REASON_TEXTS, \
-    RegisterToken, MAX_TOKEN_USES, DeletedVideo, session_scope, REASON_DUPLICATE
+    RegisterToken, MAX_TOKEN_USES, DeletedVideo, session_scope, REASON_DUPLICATE, \
+    paginate_videos_by_cursor, encode_video_cursor, videos_from_search_hits, get_theatre_summary, \
+    get_theatre_video_counts, get_pending_count, get_reference_data, has_reference, attach_reference
+from app.serve.pages import cached_page, video_page_tag, PAGE_TAG_VIDEOS
+from app.serve.sprites import thumbnail_sprite
 from app import get_environment
-from app.serve.search import search_videos, index_video_data, remove_video_data, remove_video_data_by_id, \
-    recommend_videos
+from app.serve.search import search_videos, index_video_data, remove_video_data, remove_video_data_by_ids, \
+    MAX_SEARCH_WINDOW, recommend_videos, get_related_videos, forget_related_videos
 from app.extensions import cache
-from app.core.tasks import gen_images_task, check_all_duplicates_task, \
+from app.core.tasks import gen_images_task, check_all_duplicates_task, fingerprint_archive_task, queue_related_refresh, \
     COMPARE_DURATION_THRESHOLD, COMPARE_RATIO_THRESHOLD, COMPARE_IMAGE_DATA_THRESHOLD
+from app.dl.duplicates import hash_distance, HASH_DISTANCE_THRESHOLD, FINGERPRINT_MATCH_THRESHOLD, \
+    AUDIO_MATCH_THRESHOLD
+from app.dl.features import thumbnail_features, video_fingerprints, audio_fingerprints
 
 
 # Setup
@@ -48,6 +61,10 @@ load_dotenv()
 APPLICATION_ENV = get_environment()
 MAX_RESULT_PER_PAGE = 30
 MAX_RELATED_VIDEOS = 12
+MAX_BYTE_RANGES = 16
+RANGE_CHUNK_SIZE = 64 * 1024
+IMAGE_NAME_PATTERN = re.compile(r"^[\w-]+_(thumb|preview)_[0-9a-f]+\.jpg$")
+SPRITE_NAME_PATTERN = re.compile(r"^[0-9a-f]{40}\.jpg$")
 TORRENT_NAME = "Posterity.Ukraine.archive.torrent"
 
 
@@ -77,33 +94,17 @@ def before_request_func():
 @serve.context_processor
 def inject_pending_count():
     if current_user.check_auth(AUTH_LEVEL_USER):
-        q = db_session.query(Video).filter(
-            or_(
-                Video.status!=STATUS_COMPLETED,
-                Video.verified!=True
-            )
-        )
-        if not current_user.check_auth(AUTH_LEVEL_EDITOR):
-            q = q.filter(
-                or_(
-                    Video.source=="Anonymous",
-                    Video.source==current_user.username
-                )
-            )
-
-        pending = q.filter_by(private=False).count()
-        return dict(pending_count=pending)
+        return dict(pending_count=get_pending_count(current_user))
     return dict(pending_count=0)
 
 
 @serve.context_processor
 def inject_theatre_object():
-    theaters = db_session.query(Theatre).all()
-    theaters = sorted(theaters, key=lambda x: x.video_count, reverse=True)
+    theaters = get_theatre_summary()
     # theaters = sorted(theaters, key=lambda x: x.ongoing, reverse=True)
     if "theatre" in session:
         if session["theatre"] != "all":
-            theatre = db_session.query(Theatre).filter_by(stub=session["theatre"]).first()
+            theatre = next((t for t in theaters if t.stub == session["theatre"]), None)
             if theatre:
                 return dict(
                     current_theatre=theatre,
@@ -115,7 +116,7 @@ def inject_theatre_object():
 @serve.after_request
 def after_request(response):
     if request.path.startswith("/view"):
-        response.headers.add('Accept-Ranges', 'bytes')
+        response.headers.setdefault('Accept-Ranges', 'bytes')
     return response
 
 
@@ -181,67 +182,64 @@ def sitemap():
 
 
 @serve.route("/", methods=["GET"])
+@cached_page(PAGE_TAG_VIDEOS)
 def front_page():
     page = request.args.get("p", type=int, default=1)
     pp = request.args.get("pp", type=int, default=MAX_RESULT_PER_PAGE)
+    pp = max(1, min(pp, MAX_RESULT_PER_PAGE))
     kw = request.args.get("q", type=str, default="")
     t = request.args.get("t", type=int, default=-1)
     c = request.args.get("c", type=int, default=-1)
     th = request.args.get("th", type=int, default=-1)
     no_theatre = request.args.get("unspecified", type=int, default=0)
+    cursor = request.args.get("after", type=str, default="")
+    before = request.args.get("before", type=str, default="")
 
     tag = None
     if t >= 0:
-        tag = db_session.query(ContentTag).filter_by(id=t).first()
+        tag = get_reference_data().tags.by_id(t)
     category = None
     if c >= 0:
-        category = db_session.query(Category).filter_by(id=c).first()
+        category = get_reference_data().categories.by_id(c)
 
     theatre = None
     if th >= 0:
-        theatre = db_session.query(Theatre).filter_by(id=th).first()
+        theatre = next((t for t in get_theatre_summary() if t.id == th), None)
     elif not no_theatre:
         try:
             theatre_stub = session["theatre"]
         except KeyError:
             theatre_stub = "all"
         if theatre_stub != "all":
-            theatre = db_session.query(Theatre).filter_by(stub=theatre_stub).first()
+            theatre = next((t for t in get_theatre_summary() if t.stub == theatre_stub), None)
         else:
             theatre = None
 
     offset = max(0, page - 1) * pp
+    next_cursor, prev_cursor = "", ""
 
     if len(kw):
         logger.info(f"Searching for {kw}.")
-        results = search_videos(kw)
-        results = sorted(results, key=lambda x: x["_score"], reverse=True)
+        results = search_videos(
+            kw, size=pp, offset=offset,
+            tag_id=tag.id if tag else -1,
+            category_id=category.id if category else -1,
+            theatre_id=theatre.id if theatre else -1,
+            no_theatre=bool(no_theatre),
+            auth_level=current_user.auth_level,
+            username=current_user.username
+        ) or {"hits": [], "total": 0}
         # logger.info(results)
 
-        total = len(results)
-        videos = []
-        removed = 0
-        for result in results:
-            vq = Video.query.filter_by(video_id=result["_id"])
-            v = vq.first()
-            if v:
-                if (tag and not tag in v.tags) or (category and not category in v.categories):
-                    removed += 1
-                elif theatre and theatre not in v.theatres:
-                    removed += 1
-                elif not v.user_can_see(current_user):
-                    removed += 1
-                else:
-                    videos.append(v)
-            else:
-                removed += 1
-                remove_video_data_by_id(result["_id"])
-        videos = videos[offset: offset + MAX_RESULT_PER_PAGE]
+        hits, missing = videos_from_search_hits(results["hits"])
+        remove_video_data_by_ids(missing)
 
-        total -= removed
+        # The index can lag behind the database, so double check visibility
+        videos = [v for v in hits if v.user_can_see(current_user)]
+        total = results["total"] - len(missing)
 
     else:
-        vq = db_session.query(Video).filter(Video.status!=STATUS_PENDING)
+        vq = db_session.query(Video).options(*Video.list_options()).filter(Video.status!=STATUS_PENDING)
         if no_theatre:
             vq = vq.filter(not_(Video.theatres.any()))
         elif theatre:
@@ -251,27 +249,38 @@ def front_page():
         if tag:
             vq = vq.filter(Video.tags.any(id=tag.id))
 
-        vq = vq.order_by(
-            Video.upload_time.desc()
-        )
-        all_videos = [v for v in vq.all() if v.user_can_see(current_user)]
-        total = len(all_videos)
-        if no_theatre:
-            videos = all_videos
+        # Counted like paginate_videos_by_cursor pages, without rows lacking an upload time
+        vq = vq.filter(Video.visible_to(current_user)).filter(Video.upload_time.isnot(None))
+
+        total = vq.count()
+        if before:
+            videos, prev_cursor = paginate_videos_by_cursor(vq, before, pp, backwards=True)
+            next_cursor = encode_video_cursor(videos[-1]) if videos else ""
         else:
-            videos = all_videos[offset: offset + MAX_RESULT_PER_PAGE]
+            # Without a cursor there's no position to seek to, so deep links start over
+            if not cursor:
+                page, offset = 1, 0
+            videos, next_cursor = paginate_videos_by_cursor(vq, cursor, pp)
+            prev_cursor = encode_video_cursor(videos[0]) if cursor and videos else ""
 
     total_pages = total // pp + (1 if total % pp else 0)
+    if len(kw):
+        # ElasticSearch only pages through the first MAX_SEARCH_WINDOW hits
+        total_pages = min(total_pages, MAX_SEARCH_WINDOW // pp)
 
-    available_tags = ContentTag.query.order_by(ContentTag.category.desc(), ContentTag.name).all()
-    available_categories = Category.query.order_by(Category.name).all()
+    ref = get_reference_data()
+    available_tags = ref.tags.all
+    available_categories = ref.categories.all
 
     return render_template(
         "home.html", videos=videos,
+        sprite=thumbnail_sprite(videos),
         current_page=page,
         result_offset=offset,
         max_page=total_pages,
         per_page=pp,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
         total=total,
         total_results=len(videos),
         keyword=kw,
@@ -310,10 +319,11 @@ def front_page_search():
 
 
 @serve.route("/<video_id>", methods=["GET"])
+@cached_page(video_page_tag)
 def serve_video(video_id):
     logger.info(f"Requested video '{video_id}'.")
 
-    video = Video.query.filter_by(video_id=video_id).first()
+    video = Video.query.options(*Video.detail_options()).filter_by(video_id=video_id).first()
 
     if not video:
         dv = db_session.query(DeletedVideo).filter_by(duplicate=True).filter_by(video_id=video_id).first()
@@ -328,21 +338,20 @@ def serve_video(video_id):
             flash("That video was a duplicate, redirecting to the other version.", "warning")
             return redirect(url_for("serve.serve_video", video_id=video.video_id))
 
-    try:
-        results = recommend_videos(video, size=MAX_RELATED_VIDEOS * 2)
-        results = sorted(results, key=lambda x: x["_score"], reverse=True)
-    except Exception as e:
-        logger.error(e)
-        logger.error("Unable to get recommendations for video, error above.")
-        results = []
+    results = get_related_videos(video.video_id)
+    if results is None:
+        queue_related_refresh([video.video_id], expand=False)
+        try:
+            results = recommend_videos(video, size=MAX_RELATED_VIDEOS * 2)
+            results = sorted(results, key=lambda x: x["_score"], reverse=True)
+        except Exception as e:
+            logger.error(e)
+            logger.error("Unable to get recommendations for video, error above.")
+            results = []
 
-    recommended = []
-    for result in results:
-        v = Video.query.filter_by(video_id=result["_id"]).first()
-        if v and not v == video:
-            if v.user_can_see(current_user):
-                v.score = result["_score"]
-                recommended.append(v)
+    hits, missing = videos_from_search_hits(results)
+    remove_video_data_by_ids(missing)
+    recommended = [v for v in hits if not v == video and v.user_can_see(current_user)]
 
     recommended = recommended[:MAX_RELATED_VIDEOS]
     scores = [v.score for v in recommended]
@@ -367,6 +376,7 @@ def serve_video(video_id):
         video=video,
         dl_path="/download/" + video_id,
         recommended=recommended,
+        sprite=thumbnail_sprite(recommended + (video.pending_duplicates if current_user.check_auth(AUTH_LEVEL_USER) else [])),
         stream_path=f"/view/{video_id}.mp4" + ("?orig=0" if video.post_processed else ""),
     )
 
@@ -389,6 +399,8 @@ def claim_video_route(video_id: str):
             video.source = current_user.username
             db_session.add(video)
             db_session.commit()
+            index_video_data(video)
+            queue_related_refresh([video.video_id])
         except Exception as e:
             logger.error(e)
             flash("Something bad happened during claim, it didn't go through.", "error")
@@ -398,7 +410,7 @@ def claim_video_route(video_id: str):
 @serve.route("/edit_video/<video_id>", methods=["GET"])
 @login_required
 def edit_video_page(video_id: str):
-    video: Video = Video.query.filter_by(video_id=video_id).first()
+    video: Video = Video.query.options(*Video.detail_options()).filter_by(video_id=video_id).first()
     if not video:
         return render_template("not_found.html")
 
@@ -409,21 +421,11 @@ def edit_video_page(video_id: str):
         flash("Can't edit video right now, sorry.", "warning")
         return serve_video(video.video_id)
 
-    available_tags = ContentTag.query.order_by(ContentTag.category.desc(), ContentTag.name).all()
-    available_categories = Category.query.order_by(Category.name).all()
-    available_theatres = Theatre.query.order_by(Theatre.id).all()
-    available_theatres = sorted(available_theatres, key=lambda x: x.video_count, reverse=True)
-
-    for at in available_tags:
-        if at in video.tags:
-            at.enabled = True
-        else:
-            at.enabled = False
-    for ac in available_categories:
-        if ac in video.categories:
-            ac.enabled = True
-        else:
-            ac.enabled = False
+    ref = get_reference_data()
+    available_tags = ref.tags.all
+    available_categories = ref.categories.all
+    theatre_counts = get_theatre_video_counts()
+    available_theatres = sorted(ref.theatres.all, key=lambda x: theatre_counts.get(x.id, 0), reverse=True)
 
     return render_template(
         "edit_video.html",
@@ -460,9 +462,9 @@ def edit_video_post(video_id: str):
             logger.error("Invalid tag value in form?")
             continue
         else:
-            tag = ContentTag.query.filter_by(id=tag_id).first()
-            if tag and tag not in video.tags:
-                video.tags.append(tag)
+            tag = get_reference_data().tags.by_id(tag_id)
+            if tag and not has_reference(video.tags, tag):
+                video.tags.append(attach_reference(tag))
 
     video.categories = []
     for category_id in cl:
@@ -472,9 +474,9 @@ def edit_video_post(video_id: str):
             logger.error("Invalid category value in form?")
             continue
         else:
-            cat = Category.query.filter_by(id=category_id).first()
-            if cat and cat not in video.categories:
-                video.categories.append(cat)
+            cat = get_reference_data().categories.by_id(category_id)
+            if cat and not has_reference(video.categories, cat):
+                video.categories.append(attach_reference(cat))
     video.theatres = []
     for theatre_id in thl:
         try:
@@ -483,9 +485,9 @@ def edit_video_post(video_id: str):
             logger.error("Invalid theatre value in form?")
             continue
         else:
-            theatre = Theatre.query.filter_by(id=theatre_id).first()
-            if theatre and theatre not in video.theatres:
-                video.theatres.append(theatre)
+            theatre = get_reference_data().theatres.by_id(theatre_id)
+            if theatre and not has_reference(video.theatres, theatre):
+                video.theatres.append(attach_reference(theatre))
 
     if video.status != STATUS_DOWNLOADING:
         video.title = title
@@ -497,6 +499,7 @@ def edit_video_post(video_id: str):
     db_session.commit()
     write_metadata_to_disk(video_id, video.to_json())
     index_video_data(video)
+    queue_related_refresh([video.video_id])
 
     if video.ready_to_play:
         try:
@@ -681,15 +684,15 @@ def dashboard_page():
 
     current_tasks = []
 
-    q = db_session.query(Video).filter(
+    q = db_session.query(Video).options(*Video.dashboard_options()).filter(
         or_(Video.status != STATUS_COMPLETED, Video.user_reports.any())
     )
 
-    current_tasks = q.order_by(
+    current_tasks = q.filter(
+        Video.visible_to(current_user)
+    ).order_by(
         Video.status
     ).all()
-    if not current_user.check_auth(AUTH_LEVEL_EDITOR):
-        current_tasks = [v for v in current_tasks if v.user_can_see(current_user)]
 
     possible_duplicates = list_all_duplicates()
     possible_duplicates = [v for v in possible_duplicates if v.user_can_see(current_user)]
@@ -716,7 +719,8 @@ def dashboard_page():
     return render_template(
         "dashboard.html",
         user=current_user, tokens=tokens, other_users=other_users,
-        tasks=current_tasks, duplicates=pairs
+        tasks=current_tasks, duplicates=pairs,
+        sprite=thumbnail_sprite(v for pair in pairs for v in pair)
     )
 
 
@@ -774,7 +778,7 @@ def pending_videos():
         flash("You don't have permission to view pending videos, sorry.", "error")
         return redirect(url_for("serve.front_page"))
 
-    pending_videos = db_session.query(Video).filter(
+    pending_videos = db_session.query(Video).options(*Video.list_options()).filter(
         or_(
             Video.status!=STATUS_COMPLETED,
             Video.verified!=True
@@ -809,6 +813,8 @@ def publish_video_route(video_id: str):
             video.verified = True
             db_session.add(video)
             db_session.commit()
+            index_video_data(video)
+            queue_related_refresh([video.video_id])
             flash("Video has been published!", "success")
         else:
             flash("Video was already published", "warning")
@@ -907,8 +913,8 @@ def handle_duplicate_route(video_id1, video_id2):
         flash("You don't have permissions to handle deleting duplicates!", "error")
         return redirect(url_for("serve.front_page"))
 
-    video1 = db_session.query(Video).filter_by(video_id=video_id1).first()
-    video2 = db_session.query(Video).filter_by(video_id=video_id2).first()
+    video1 = db_session.query(Video).options(*Video.detail_options()).filter_by(video_id=video_id1).first()
+    video2 = db_session.query(Video).options(*Video.detail_options()).filter_by(video_id=video_id2).first()
     if not video1 or not video2:
         flash("Video not found", "warning")
         return render_template("not_found.html")
@@ -942,9 +948,9 @@ def handle_duplicate_route(video_id1, video_id2):
                     logger.error("Invalid tag value in form?")
                     continue
                 else:
-                    tag = ContentTag.query.filter_by(id=tag_id).first()
-                    if tag and tag not in video.tags:
-                        video.tags.append(tag)
+                    tag = get_reference_data().tags.by_id(tag_id)
+                    if tag and not has_reference(video.tags, tag):
+                        video.tags.append(attach_reference(tag))
 
             video.categories = []
             for category_id in data["categories"]:
@@ -954,9 +960,9 @@ def handle_duplicate_route(video_id1, video_id2):
                     logger.error("Invalid category value in form?")
                     continue
                 else:
-                    cat = Category.query.filter_by(id=category_id).first()
-                    if cat and cat not in video.categories:
-                        video.categories.append(cat)
+                    cat = get_reference_data().categories.by_id(category_id)
+                    if cat and not has_reference(video.categories, cat):
+                        video.categories.append(attach_reference(cat))
             video.theatres = []
             for theatre_id in data["theatres"]:
                 try:
@@ -965,9 +971,9 @@ def handle_duplicate_route(video_id1, video_id2):
                     logger.error("Invalid theatre value in form?")
                     continue
                 else:
-                    theatre = Theatre.query.filter_by(id=theatre_id).first()
-                    if theatre and theatre not in video.theatres:
-                        video.theatres.append(theatre)
+                    theatre = get_reference_data().theatres.by_id(theatre_id)
+                    if theatre and not has_reference(video.theatres, theatre):
+                        video.theatres.append(attach_reference(theatre))
 
             if video.status != STATUS_DOWNLOADING:
                 video.title = data["title"]
@@ -990,10 +996,11 @@ def handle_duplicate_route(video_id1, video_id2):
             return redirect(url_for("serve.serve_video", video_id=video1.video_id))
 
     else:
-        available_tags = ContentTag.query.order_by(ContentTag.category.desc(), ContentTag.name).all()
-        available_categories = Category.query.order_by(Category.name).all()
-        available_theatres = Theatre.query.order_by(Theatre.id).all()
-        available_theatres = sorted(available_theatres, key=lambda x: x.video_count, reverse=True)
+        ref = get_reference_data()
+        available_tags = ref.tags.all
+        available_categories = ref.categories.all
+        theatre_counts = get_theatre_video_counts()
+        available_theatres = sorted(ref.theatres.all, key=lambda x: theatre_counts.get(x.id, 0), reverse=True)
 
         return render_template(
             "handle_duplicates.html",
@@ -1056,23 +1063,16 @@ def download_archive():
 @serve.route("/download/<video_id>")
 def download_video(video_id=""):
     video = db_session.query(Video).filter_by(video_id=video_id).first()
-    orig = request.args.get("orig", 1)
+    orig = request.args.get("orig", type=int, default=1)
+    height = request.args.get("h", type=int, default=0)
 
     if not video:
         return Response(render_template("not_found.html"), 404)
 
-    if orig == 0:
-        first_p = processed_path
-        last_p = original_path
-    else:
-        first_p = original_path
-        last_p = processed_path
-
     try:
-        if os.path.isfile(os.path.join(first_p, video_id + ".mp4")):
-            return send_from_directory(first_p, video_id + ".mp4", as_attachment=True, conditional=True)
-        elif os.path.isfile(os.path.join(last_p, video_id + ".mp4")):
-            return send_from_directory(last_p, video_id + ".mp4", as_attachment=True, conditional=True)
+        file_path = video.video_file(original=orig != 0, height=height)
+        if file_path:
+            return send_media_file(os.path.dirname(file_path), os.path.basename(file_path), as_attachment=True)
     except OSError as e:
         logger.error(e)
         logger.error("Unable to serve video!")
@@ -1082,22 +1082,18 @@ def download_video(video_id=""):
 @serve.route("/view/<video_id>.mp4")
 def view_video(video_id=""):
     original = request.args.get("orig", type=int, default=0)
-    processed = False
+    height = request.args.get("h", type=int, default=0)
     try:
         video = db_session.query(Video).filter_by(video_id=video_id).first()
     except Exception as e:
         logger.error(e)
-    else:
-        processed = video.post_processed
+        video = None
 
     resp = None
     try:
-        if processed and not original:
-            proc_path = os.path.join(processed_path, f"{video_id}.mp4")
-            if os.path.isfile(proc_path):
-                resp = send_from_directory_partial(processed_path, f"{video_id}.mp4")
-        if os.path.isfile(os.path.join(original_path, f"{video_id}.mp4")) and not resp:
-            resp = send_from_directory_partial(original_path, f"{video_id}.mp4")
+        file_path = video.video_file(original=bool(original), height=height) if video else ""
+        if file_path:
+            resp = send_media_file(os.path.dirname(file_path), os.path.basename(file_path), partial=True)
     except OSError as e:
         logger.error(e)
         logger.error("Unable to serve video!")
@@ -1133,17 +1129,69 @@ def view_video(video_id=""):
     return "Video file not found."
 
 
+@serve.route("/hls/<video_id>/<file_name>")
+def view_hls(video_id="", file_name=""):
+    if not os.path.splitext(file_name)[1] in (".m3u8", ".m4s", ".mp4"):
+        return Response("", 404)
+    video = db_session.query(Video).filter_by(video_id=video_id).first()
+    if not video or not video.hls_playlist or not video.user_can_see(current_user):
+        return Response("", 404)
+
+    resp = send_media_file(os.path.join(hls_path, video.video_id), file_name)
+    if video.is_public:
+        resp.cache_control.public = True
+    else:
+        resp.cache_control.private = True
+    resp.cache_control.max_age = HLS_PLAYLIST_MAX_AGE if file_name == HLS_PLAYLIST else HLS_SEGMENT_MAX_AGE
+    return resp
+
+
+@serve.route("/img/<file_name>")
+def view_image(file_name=""):
+    """
+        Published images are named by their content, so they are sent without a DB lookup and
+        can be cached forever. A front server may as well serve image_path directly.
+    """
+    if not IMAGE_NAME_PATTERN.match(file_name):
+        return Response("", 404)
+    resp = send_image_file(image_path, file_name)
+    resp.headers["Cache-Control"] = f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable"
+    return resp
+
+
+@serve.route("/sprites/<file_name>")
+def view_sprite(file_name=""):
+    if not SPRITE_NAME_PATTERN.match(file_name):
+        return Response("", 404)
+    resp = send_image_file(sprite_path, file_name)
+    resp.headers["Cache-Control"] = f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable"
+    return resp
+
+
+@serve.route("/storyboard/<video_id>.<ext>")
+def view_storyboard(video_id="", ext=""):
+    if ext not in ("jpg", "vtt"):
+        return Response("", 404)
+    video = db_session.query(Video).filter_by(video_id=video_id).first()
+    if not video or not video.user_can_see(current_user):
+        return Response("", 404)
+    file_path = video.storyboard_file(ext)
+    if not file_path:
+        return Response("", 404)
+    resp = send_media_file(storyboard_path, os.path.basename(file_path))
+    resp.cache_control.private = True
+    resp.cache_control.max_age = STORYBOARD_CACHE_MAX_AGE
+    return resp
+
+
 @serve.route("/preview/<video_id>.jpg")
 def get_preview_image(video_id=""):
     video = Video.query.filter_by(video_id=video_id).first()
     try:
         if video:
-            if os.path.isfile(os.path.join(current_app.config["PREVIEW_FOLDER"], video_id + "_preview_blurred.jpg")):
-                for ct in video.tags:
-                    if ct.category > 1:
-                        return send_from_directory(current_app.config["PREVIEW_FOLDER"], video_id + "_preview_blurred.jpg")
-            if os.path.isfile(os.path.join(current_app.config["PREVIEW_FOLDER"], video_id + "_preview.jpg")):
-                return send_from_directory(current_app.config["PREVIEW_FOLDER"], video_id + "_preview.jpg")
+            file_path = video.image_file(current_app.config["PREVIEW_FOLDER"], "preview")
+            if file_path:
+                return send_image_file(current_app.config["PREVIEW_FOLDER"], os.path.basename(file_path))
     except Exception as e:
         logger.error(e)
         logger.error("Unhandled exception during fetching of preview image.")
@@ -1163,12 +1211,9 @@ def get_thumbnail_image(video_id=""):
     try:
         video = Video.query.filter_by(video_id=video_id).first()
         if video:
-            if os.path.isfile(os.path.join(current_app.config["THUMBNAIL_FOLDER"], video_id + "_thumb_blurred.jpg")):
-                for ct in video.tags:
-                    if ct.category > 1:
-                        return send_from_directory(current_app.config["THUMBNAIL_FOLDER"], video_id + "_thumb_blurred.jpg")
-            if os.path.isfile(os.path.join(current_app.config["THUMBNAIL_FOLDER"], video_id + "_thumb.jpg")):
-                return send_from_directory(current_app.config["THUMBNAIL_FOLDER"], video_id + "_thumb.jpg")
+            file_path = video.image_file(current_app.config["THUMBNAIL_FOLDER"], "thumb")
+            if file_path:
+                return send_image_file(current_app.config["THUMBNAIL_FOLDER"], os.path.basename(file_path))
     except Exception as e:
         logger.error(e)
         logger.error("Unhandled exception during fetching of thumbnail image.")
@@ -1256,6 +1301,21 @@ def check_all_duplicates_route():
     return redirect(url_for("serve.dashboard_page"))
 
 
+@serve.route("/fingerprint_archive", methods=["GET"])
+@login_required
+@cache.cached(timeout=30)
+def fingerprint_archive_route():
+    if not current_user.check_auth(AUTH_LEVEL_EDITOR):
+        flash("You're lacking permissions to do that.", "error")
+        return redirect(url_for("serve.dashboard_page"))
+
+    fingerprint_archive_task.delay()
+
+    flash("Started fingerprinting the archive, this takes a while for older videos.", "success")
+
+    return redirect(url_for("serve.dashboard_page"))
+
+
 @serve.route("/check_status")
 @cache.cached(timeout=10)
 def check_status():
@@ -1297,7 +1357,7 @@ def set_theatre_route(theatre_id):
         return redirect(redir_path, code=302)
 
     if theatre_id >= 0:
-        theatre = db_session.query(Theatre).filter_by(id=theatre_id).first()
+        theatre = get_reference_data().theatres.by_id(theatre_id)
         if theatre:
             session["theatre"] = theatre.stub
         else:
@@ -1315,7 +1375,7 @@ def theatre_route():
         flash("You don't have permissions for that.", "error")
         return redirect(url_for("serve.front_page"))
 
-    theaters = db_session.query(Theatre).all()
+    theaters = get_theatre_summary()
 
     return render_template("theatres.html", theaters=theaters)
 
@@ -1441,11 +1501,15 @@ def delete_video_by_id(video_id: str) -> bool:
 
     # Remove search engine index
     remove_video_data(v)
+    referencing = forget_related_videos(v.video_id)
+    if len(referencing):
+        queue_related_refresh(list(referencing), expand=False)
     write_metadata_to_disk(v.video_id, v.to_json())
 
     # Delete from database
     db_session.delete(v)
     db_session.commit()
+    remove_derived_media(video_id)
 
     if os.path.isfile(os.path.join(original_path, video_id + ".mp4")):
         try:
@@ -1533,6 +1597,7 @@ def restore_video_by_id(video_id: str) -> bool:
         flash("Did not find original json file!", "warning")
 
     index_video_data(v)
+    queue_related_refresh([v.video_id])
 
     db_session.add(v)
     db_session.delete(dv)
@@ -1602,7 +1667,7 @@ def get_metadata_for_video(video_id: str) -> dict:
 
 def list_all_duplicates() -> list:
     try:
-        return db_session.query(Video).filter(Video.duplicates.any()).order_by(
+        return db_session.query(Video).options(*Video.dashboard_options()).filter(Video.duplicates.any()).order_by(
             Video.upload_time.desc()
         ).all()
     except Exception as e:
@@ -1613,57 +1678,72 @@ def list_all_duplicates() -> list:
 @cache.memoize(timeout=60)
 def get_possible_duplicates(video_id: str, tmp_session) -> list:
     try:
-        from imgcompare import is_equal
-        from PIL import Image
         candidates = []
 
         video = tmp_session.query(Video).filter_by(video_id=video_id).first()
-        if not video:
+        if not video or not video.duration:
             return candidates
-
-        db_vids = tmp_session.query(Video).filter(Video.video_id != video_id).filter_by(status=STATUS_COMPLETED).all()
-
-        duration_candidates = []
-
-        vid_q = []
-        for v in db_vids:
-            if v not in video.false_positives and video not in v.false_positives:
-                vid_q.append(v)
-
-        for v in vid_q:
-            if v.duration and video.duration:
-                if abs(1.0 - v.duration / video.duration) <= COMPARE_DURATION_THRESHOLD:
-                    duration_candidates.append(v)
-                    continue
-
-        aspect_ratio_candidates = []
-        for v in duration_candidates:
-            if abs(v.aspect_ratio - video.aspect_ratio) <= COMPARE_RATIO_THRESHOLD:
-                aspect_ratio_candidates.append(v)
-                continue
+        if not video.image_hash:
+            video.update_image_hash()
+
+        # The duration and aspect ratio windows as index range scans
+        aspect_ratio_candidates = tmp_session.query(Video).filter(
+            Video.status == STATUS_COMPLETED,
+            Video.duration.between(
+                video.duration * (1.0 - COMPARE_DURATION_THRESHOLD),
+                video.duration * (1.0 + COMPARE_DURATION_THRESHOLD)
+            ),
+            Video.aspect_ratio.between(
+                video.aspect_ratio - COMPARE_RATIO_THRESHOLD,
+                video.aspect_ratio + COMPARE_RATIO_THRESHOLD
+            ),
+            Video.video_id != video_id
+        ).all()
+        aspect_ratio_candidates = [
+            v for v in aspect_ratio_candidates
+            if v not in video.false_positives and video not in v.false_positives
+        ]
 
         vid_thumb_path = os.path.join(current_app.config["THUMBNAIL_FOLDER"], video_id + "_thumb.jpg")
 
         if os.path.isfile(vid_thumb_path):
+            # Videos from before the feature store are added once, later checks don't decode
+            thumbnail_features.add_thumbnails(
+                [v.video_id for v in [video] + aspect_ratio_candidates if v.video_id not in thumbnail_features]
+            )
+            scores = thumbnail_features.compare(video_id, [v.video_id for v in aspect_ratio_candidates])
+            alignments = video_fingerprints.score(video_id, [v.video_id for v in aspect_ratio_candidates])
+
             img_candidates = []
             for v in aspect_ratio_candidates:
-                other_thumb_path = os.path.join(current_app.config["THUMBNAIL_FOLDER"], v.video_id + "_thumb.jpg")
-                if os.path.isfile(other_thumb_path):
-                    try:
-                        img1 = Image.open(vid_thumb_path)
-                        img2 = Image.open(other_thumb_path)
-                        img1 = img1.resize((64, 64))
-                        img2 = img2.resize((64, 64))
-                        if is_equal(img1, img2, tolerance=COMPARE_IMAGE_DATA_THRESHOLD):
-                            img_candidates.append(v)
-                            continue
-                    except Exception as e:
-                        logger.error(e)
-                        continue
+                if alignments.get(v.video_id, 0.0) >= FINGERPRINT_MATCH_THRESHOLD:
+                    img_candidates.append(v)
+                elif v.video_id in scores:
+                    if scores[v.video_id] < COMPARE_IMAGE_DATA_THRESHOLD:
+                        img_candidates.append(v)
+                elif video.image_hash and v.image_hash:
+                    if hash_distance(video.image_hash, v.image_hash) <= HASH_DISTANCE_THRESHOLD:
+                        img_candidates.append(v)
 
             candidates = img_candidates
         else:
             candidates = aspect_ratio_candidates
+
+        # The same audio is matched across the whole archive, crops change the aspect ratio
+        audio_ids = [i for i, score in audio_fingerprints.find(video_id).items() if score >= AUDIO_MATCH_THRESHOLD]
+        if audio_ids:
+            audio_candidates = tmp_session.query(Video).filter(
+                Video.status == STATUS_COMPLETED,
+                Video.duration.between(
+                    video.duration * (1.0 - COMPARE_DURATION_THRESHOLD),
+                    video.duration * (1.0 + COMPARE_DURATION_THRESHOLD)
+                ),
+                Video.video_id.in_(audio_ids)
+            ).all()
+            candidates += [
+                v for v in audio_candidates
+                if v not in candidates and v not in video.false_positives and video not in v.false_positives
+            ]
         return [c.video_id for c in candidates]
     except Exception as e:
         logger.error(e)
@@ -1671,44 +1751,133 @@ def get_possible_duplicates(video_id: str, tmp_session) -> list:
         return []
 
 
-def send_from_directory_partial(directory, filename):
+def offload_location(path: str) -> str:
     """
-        Simple wrapper around send_file which handles HTTP 206 Partial Content
-        (byte ranges)
-        TODO: handle all send_file args, mirror send_file's error handling
-        (if it has any)
+        The internal location of a file under the longest matching MEDIA_OFFLOAD_LOCATIONS
+        directory, so subdirectories like hls/<video_id> are covered by their parent.
     """
-    range_header = request.headers.get('Range', None)
-    if not range_header:
-        return send_from_directory(directory, filename, conditional=True)
+    best = ""
+    for directory in current_app.config.get("MEDIA_OFFLOAD_LOCATIONS", {}):
+        if path.startswith(directory.rstrip(os.sep) + os.sep) and len(directory) > len(best):
+            best = directory
+    if not best:
+        return ""
+    location = current_app.config["MEDIA_OFFLOAD_LOCATIONS"][best]
+    return location.rstrip("/") + "/" + os.path.relpath(path, best).replace(os.sep, "/")
 
-    path = os.path.join(directory, filename)
-    size = os.path.getsize(path)
-    byte1, byte2 = 0, None
-
-    m = re.search('(\d+)-(\d*)', range_header)
-    g = m.groups()
 
-    if g[0]: byte1 = int(g[0])
-    if g[1]: byte2 = int(g[1])
+def send_media_file(directory, filename, as_attachment: bool = False, partial: bool = False):
+    """
+        Sends a media file, or with MEDIA_OFFLOAD set, only an X-Accel-Redirect or X-Sendfile
+        header so the front server streams it. Directories without an x-accel location in
+        MEDIA_OFFLOAD_LOCATIONS are still served from here.
+    """
+    mode = current_app.config.get("MEDIA_OFFLOAD", "")
+    header = None
+    if mode:
+        path = safe_join(directory, filename)
+        if path is None:
+            abort(404)
+        if mode == "x-sendfile":
+            header = ("X-Sendfile", os.path.abspath(path))
+        elif mode == "x-accel":
+            location = offload_location(os.path.abspath(path))
+            if location:
+                header = ("X-Accel-Redirect", quote(location))
+        else:
+            logger.error(f"Unknown MEDIA_OFFLOAD mode '{mode}', serving file directly.")
+
+    if header:
+        if not os.path.isfile(path):
+            abort(404)
+        rv = Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        rv.headers[header[0]] = header[1]
+        if as_attachment:
+            rv.headers["Content-Disposition"] = f"attachment; filename={quote(filename)}"
+        return rv
+    if partial:
+        return send_from_directory_partial(directory, filename)
+    return send_from_directory(directory, filename, as_attachment=as_attachment, conditional=True)
+
+
+def send_image_file(directory, filename):
+    """
+        Sends the smallest of a JPEG and its WebP/AVIF variants that the client accepts.
+    """
+    path = pick_image_variant(os.path.join(directory, filename), request.headers.get("Accept", ""))
+    resp = send_media_file(directory, os.path.basename(path))
+    resp.vary.add("Accept")
+    return resp
+
+
+def _iter_byte_ranges(path: str, parts: list, trailer: bytes, chunk_size: int = RANGE_CHUNK_SIZE):
+    with open(path, "rb") as f:
+        for header, start, stop in parts:
+            yield header
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+            yield b"\r\n"
+    yield trailer
 
-    length = size - byte1
-    if byte2 is not None:
-        length = byte2 - byte1
 
-    data = None
-    with open(path, 'rb') as f:
-        f.seek(byte1)
-        try:
-            data = f.read(length)
-        except ValueError:
-            logger.error("Error when reading video file, length given is wrong.")
-            data = b""
+def send_from_directory_partial(directory, filename):
+    """
+        send_from_directory with support for multiple byte ranges. Single ranges, suffix
+        ranges, If-Range and 416 are handled by send_file's own conditional logic, several
+        ranges are streamed back as multipart/byteranges in fixed size chunks.
+    """
+    ranges = parse_range_header(request.headers.get("Range"))
+    if ranges is None or len(ranges.ranges) < 2 or len(ranges.ranges) > MAX_BYTE_RANGES:
+        return send_from_directory(directory, filename, conditional=True)
 
-    rv = Response(data,
-                  206,
-                  mimetype=mimetypes.guess_type(path)[0],
-                  direct_passthrough=True)
-    rv.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size))
+    base = send_from_directory(directory, filename, conditional=False)
+    base.close()
+    etag, _weak = base.get_etag()
+    if "HTTP_IF_RANGE" in request.environ and is_resource_modified(
+            request.environ, etag, None, base.last_modified, ignore_if_range=False):
+        return send_from_directory(directory, filename, conditional=True)
 
+    path = safe_join(directory, filename)
+    size = os.path.getsize(path)
+    satisfiable = []
+    for start, stop in ranges.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            satisfiable.append((start, stop))
+    if not len(satisfiable):
+        return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+
+    boundary = uuid.uuid4().hex
+    mimetype = base.mimetype
+    parts = []
+    trailer = f"--{boundary}--\r\n".encode("latin-1")
+    length = len(trailer)
+    for start, stop in satisfiable:
+        header = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+        ).encode("latin-1")
+        parts.append((header, start, stop))
+        length += len(header) + (stop - start) + 2
+
+    rv = Response(
+        _iter_byte_ranges(path, parts, trailer),
+        206,
+        mimetype=f"multipart/byteranges; boundary={boundary}",
+        direct_passthrough=True
+    )
+    rv.content_length = length
+    rv.set_etag(etag)
+    rv.last_modified = base.last_modified
+    rv.headers["Accept-Ranges"] = "bytes"
     return rv
@@ -0,0 +1 @@
+from app.media.server import app
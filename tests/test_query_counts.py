@@ -0,0 +1,119 @@
+"""
+    The front page, a video page and the dashboard render in a fixed number of statements,
+    however many videos, duplicates and reports they show.
+"""
+import os
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+os.environ["POSTERITY_DB"] = "sqlite://"
+# Production doesn't rebuild the search index on startup
+os.environ["APPLICATION_ENV"] = "production"
+os.environ.setdefault("SECRET_KEY", "query-count-test")
+
+from sqlalchemy import event
+
+from app import create_app, celery
+from app.dl import STATUS_COMPLETED, STATUS_PROCESSING
+from app.extensions import cache
+from app.serve.db import Base, engine, db_session, Video, ContentTag, Category, Theatre, User, UserReport, \
+    tag_association_table, category_association_table, theatre_association_table, video_duplicates, \
+    AUTH_LEVEL_EDITOR
+
+
+VIDEO_COUNT = 20
+
+app = create_app()
+app.config["TESTING"] = True
+# Every request renders, and queued tasks stay in memory
+cache.init_app(app, config={"CACHE_TYPE": "NullCache"})
+celery.conf.update(broker_url="memory://")
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def insert_videos(first: int, count: int):
+    """
+        Core inserts, so no session listeners run. Every video is a duplicate of the first,
+        every third one is reported and every other one is still processing.
+    """
+    ids = range(first, first + count)
+    with engine.begin() as conn:
+        conn.execute(Video.__table__.insert(), [
+            {
+                "id": i, "video_id": f"video{i}", "title": f"Video {i}", "duration": 10.0 + i,
+                "status": STATUS_COMPLETED if i % 2 else STATUS_PROCESSING, "verified": True,
+                "private": False, "source": "Anonymous", "upload_time": datetime(2024, 1, 1) + timedelta(minutes=i)
+            }
+            for i in ids
+        ])
+        conn.execute(tag_association_table.insert(), [{"video_id": i, "tag_id": 1 + i % 2} for i in ids])
+        conn.execute(category_association_table.insert(), [{"video_id": i, "category_id": 1} for i in ids])
+        conn.execute(theatre_association_table.insert(), [{"video_id": i, "theatre_id": 1} for i in ids])
+        conn.execute(video_duplicates.insert(), [{"video_id": 1, "duplicate_id": i} for i in ids if i != 1])
+        conn.execute(UserReport.__table__.insert(), [
+            {"video_db_id": i, "text": "", "reason": 0, "source": "Anonymous", "report_time": datetime(2024, 1, 2)}
+            for i in ids if i % 3 == 0
+        ])
+
+
+class QueryCountTest(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(ContentTag.__table__.insert(), [
+                {"id": 1, "name": "Graphic", "stub": "graphic", "category": 1},
+                {"id": 2, "name": "Audio", "stub": "audio", "category": 0},
+            ])
+            conn.execute(Category.__table__.insert(), [{"id": 1, "name": "Combat", "stub": "combat"}])
+            conn.execute(Theatre.__table__.insert(), [{"id": 1, "name": "Ukraine", "stub": "ukraine"}])
+            conn.execute(User.__table__.insert(), [{"id": 1, "username": "editor", "auth_level": AUTH_LEVEL_EDITOR}])
+        insert_videos(1, VIDEO_COUNT)
+
+    def tearDown(self):
+        db_session.remove()
+        Base.metadata.drop_all(engine)
+
+    def render(self, path: str, login: bool = False) -> int:
+        client = app.test_client()
+        if login:
+            with client.session_transaction() as session:
+                session["_user_id"] = "1"
+                session["_fresh"] = True
+        # Reference data and the like are loaded once per process, not per page
+        client.get(path)
+        with count_queries() as statements:
+            response = client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def assertConstantQueries(self, path: str, login: bool = False):
+        before = self.render(path, login)
+        insert_videos(VIDEO_COUNT + 1, VIDEO_COUNT)
+        self.assertEqual(self.render(path, login), before)
+
+    def test_front_page(self):
+        self.assertConstantQueries("/")
+
+    def test_video_page(self):
+        self.assertConstantQueries("/video1")
+
+    def test_dashboard(self):
+        self.assertConstantQueries("/dashboard", login=True)
+
+
+if __name__ == "__main__":
+    unittest.main()